@@ -1,14 +1,23 @@
-import sys, os, shlex, time, csv, shutil
+import sys, os, shlex, time, argparse, resource, asyncio, signal, hashlib, json, gzip, selectors
 from elftools.elf.elffile import ELFFile
+from elftools.elf.constants import SH_FLAGS
 from elftools.common.exceptions import ELFError
 from capstone import *
 from capstone.x86 import *
+from capstone.arm import ARM_OP_IMM, ARM_REG_PC
 from pathlib import Path
 from subprocess import Popen,PIPE,TimeoutExpired
 from multiprocessing import Pool
 from functools import partial
+from itertools import chain, islice
+from bisect import bisect_left, bisect_right
+from copy import copy
+from collections import Counter
+from contextlib import nullcontext
 
-sys.path.insert(1, 'swifitool') # use swifitool folder for file exports
+# use swifitool folder for file exports, wherever chaosduck.py is imported from
+# (the workers of distributed.py may run in any directory)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swifitool'))
 
 from faults_inject import ExecConfig
 from faults.jbe import JBE
@@ -17,9 +26,134 @@ from faults.z1b import Z1B
 from faults.z1w import Z1W
 from faults.nop import NOP
 from faults.flp import FLP
+from faults.multi import MULTI
+from forkserver import ForkServer, set_limits, trace_executed as trace_native
+from qemuserver import QemuServer, check_qemu, trace_executed as trace_qemu
+from emulator import Emulator, parse_args_spec, hex_to_bytes
+from resultstore import open_store, fault_fields, Journal, BATCH
+from sampling import StratifiedSampler
+from elfinfo import code_address, function_range
+from distributed import Coordinator
 
-def extract_x86_instructions(infile):
+# test vectors every faulty binary is run with
+KEYS = ["00010203040506070809","01234567890987654321","deadbeafdeadc0debabe"]
+PLAINTEXTS = ["badf00dbadc0ffee","deadbeafbabec0de","1ceb00dab10sf00d"]
+GOLDEN_RUNS = 3     # runs of the original binary timed for each test vector
+MIN_TIMEOUT = 0.1   # lower bound of the adaptive timeouts, in seconds
+# range of the displacement of each jump encoding of JMP and JBE: rel8,
+# rel32 and rel16 on x86, and the 24-bit word offset of B/BL on ARM
+DISPLACEMENTS = {0:(-2**7, 2**7), 1:(-2**31, 2**31), 2:(-2**15, 2**15), 3:(-2**25, 2**25)}
+UNDEFINED = ('ud0', 'ud1', 'ud2', 'udf')   # instructions that raise an invalid opcode
+NOPS = ('nop', 'endbr32', 'endbr64')
+CACHE_VERSION = 2   # version of the cached disassembly and traces, changed with their format
+
+def trace_binary(infile, arch, jobs, cache_dir=None):
+    # addresses of the instructions of the binary executed by the original
+    # binary with any of the test vectors, traced in parallel
+    vectors = [[key,plaintext] for key in KEYS for plaintext in PLAINTEXTS]
+    cache_key = binary_key(infile, 'trace', arch, vectors)
+    executed = load_cache(cache_dir, cache_key)
+    if executed is None:
+        print("Tracing the original binary with the test vectors...\n")
+        trace = trace_native if arch=='x86' else trace_qemu
+        with Pool(processes=min(jobs, len(vectors))) as pool:
+            executed = sorted(set().union(*pool.map(partial(trace, infile), vectors)))
+        save_cache(cache_dir, cache_key, executed)
+    print("Number of executed instructions: ", len(executed))
+    return set(executed)
+
+def capstone_mode(infile, arch):
+    # capstone architecture and mode of a binary, x86 binaries are decoded in
+    # the mode of their ELF class
+    if arch=='arm':
+        return CS_ARCH_ARM, CS_MODE_ARM
+    with open(infile, 'rb') as file:
+        return CS_ARCH_X86, CS_MODE_64 if ELFFile(file).elfclass == 64 else CS_MODE_32
+
+def resolve_scope(infile, specs):
+    # address ranges of functions given by name (symbol table or DWARF) or
+    # given as START-END virtual addresses
+    ranges = []
+    for spec in specs:
+        start, sep, end = spec.partition('-')
+        if not sep:
+            ranges.append(function_range(infile, spec))
+            continue
+        try:
+            ranges.append((int(start,0), int(end,0)))
+        except ValueError:
+            raise ValueError("Invalid address range : %s" %spec)
+    return ranges
+
+def scope_chunks(ops, addr, include, exclude):
+    # parts of a section to disassemble: the included ranges (the whole section
+    # by default) minus the excluded ones
+    end = addr + len(ops)
+    if include is None:
+        chunks = [(addr, end)]
+    else:
+        chunks = [(max(s,addr), min(e,end)) for s, e in include]
+    for xs, xe in exclude or []:
+        chunks = [part for s, e in chunks for part in ((s, min(e,xs)), (max(s,xe), e))]
+    for s, e in sorted(chunks):
+        if s < e:
+            yield ops[s-addr:e-addr], s
+
+def mark_blocks(allinstr, leaders):
+    # an instruction starts a basic block if it is a leader or if it does not
+    # follow the previous instruction (first of a section or of a range)
+    end = None
+    for i in allinstr:
+        i['block'] = i['addr'] in leaders or i['addr'] != end
+        end = i['addr'] + i['size']
+
+def function_symbols(infile, arch):
+    # [start, end) addresses and names of the functions of the symbol table,
+    # in the addresses of the disassembly (file offsets on ARM)
+    with open(infile, 'rb') as file:
+        elffile = ELFFile(file)
+        symtab = elffile.get_section_by_name('.symtab')
+        if symtab is None:
+            return []
+        functions = {}
+        for symbol in symtab.iter_symbols():
+            if symbol['st_info']['type'] != 'STT_FUNC' or symbol['st_size'] == 0 or \
+                    not isinstance(symbol['st_shndx'], int):
+                continue
+            start = code_address(elffile, arch, symbol['st_value'])
+            functions.setdefault((start, start + symbol['st_size']), symbol.name)
+        return sorted((start, end, name) for (start, end), name in functions.items())
+
+def function_ranges(infile, arch):
+    return [(start, end) for start, end, name in function_symbols(infile, arch)]
+
+def fault_strata(infile, arch):
+    # the stratum of a fault is its model, and the section and function of its
+    # first faulted byte
+    with open(infile, 'rb') as file:
+        elffile = ELFFile(file)
+        sections = []
+        for section in elffile.iter_sections():
+            if section['sh_flags'] & SH_FLAGS.SHF_EXECINSTR and section['sh_size']:
+                start = section['sh_offset'] if arch=='arm' else section['sh_addr']
+                sections.append((start, start + section['sh_size'], section.name))
+    sections.sort()
+    functions = function_symbols(infile, arch)
+    def locate(ranges, addr):
+        i = bisect_right(ranges, (addr, float('inf'))) - 1
+        if i >= 0 and addr < ranges[i][1]:
+            return ranges[i][2]
+        return '?'
+    def stratum(f):
+        fields = fault_fields(f)
+        return (fields['model'], locate(sections, fields['address']), locate(functions, fields['address']))
+    return stratum
+
+def extract_x86_instructions(infile, executed=None, include=None, exclude=None):
+    # with the executed addresses of a trace, every instruction is kept as a
+    # jump target but only the executed ones are faulted
     print("Disassembling the binary and parsing instructions...\n");
+    mode = capstone_mode(infile, 'x86')
     infile = open(infile, 'rb')
     # ELFFile looks for magic number, if there's none, ELFError is raised
     try:
@@ -34,11 +168,12 @@ def extract_x86_instructions(infile):
         jumps = []  # array for jmp instructions
         cmpsmovs = []   # array for cmp and mov instructions
         allinstr = []   # all instructions' addresses and their size in bytes
+        leaders = set() # first instructions of basic blocks: branch targets and instructions after a branch
         for section in elffile.iter_sections():
             ops = section.data()
             addr = section['sh_addr']
             name = section.name
-            md = Cs(CS_ARCH_X86, CS_MODE_32)
+            md = Cs(*mode)
             md.detail = True
             # print("%x\t%s\t%s" %(i.address, i.mnemonic, i.op_str))
             # print("%x:\t%s\t%s\t" %(i.address, i.mnemonic, i.op_str) +
@@ -48,11 +183,20 @@ def extract_x86_instructions(infile):
             if name == ".rodata": parsing = False
             elif name == ".init" or parsing:
                 parsing = True
-                for i in md.disasm(ops, addr):
+                for i in chain.from_iterable(md.disasm(chunk, start)
+                                             for chunk, start in scope_chunks(ops, addr, include, exclude)):
                     # determine the heap range
                     if i.address < startAddress: startAddress=i.address
                     if i.address > endAddress: endAddress=i.address
-                    allinstr.append({'addr':i.address, 'size':i.size})
+                    allinstr.append({'addr':i.address, 'size':i.size,
+                        'executed':executed is None or i.address in executed})
+                    if i.group(CS_GRP_JUMP) or i.group(CS_GRP_CALL):
+                        if i.operands and i.operands[0].type == X86_OP_IMM:
+                            leaders.add(i.operands[0].imm)
+                    if i.group(CS_GRP_JUMP) or i.group(CS_GRP_RET) or i.group(CS_GRP_IRET):
+                        leaders.add(i.address + i.size)
+                    if not allinstr[-1]['executed']:
+                        continue
                     # print("%x\t%s\t%s\t%d" %(i.address, i.mnemonic, i.op_str, i.size))
                     # determine the instruction type and parse accordingly
                     if i.mnemonic in supjumps:  # select only jump instructions
@@ -94,11 +238,12 @@ def extract_x86_instructions(infile):
                                     loc = hex(i.address + (i.size - 4)) # 4 bytes
                             if loc!=0:
                                 cmpsmovs.append({'type':i.mnemonic,'size':size,'loc':loc})
+        mark_blocks(allinstr, leaders)
         return allinstr, jumps, cmpsmovs
     except ELFError:
         logging.info("%s is invalid elf file" % elffile)
 
-def extract_arm_instructions(infile):
+def extract_arm_instructions(infile, executed=None, include=None, exclude=None):
     print("Disassembling the binary and parsing instructions...\n");
     infile = open(infile, 'rb')
     # ELFFile looks for magic number, if there's none, ELFError is raised
@@ -115,6 +260,7 @@ def extract_arm_instructions(infile):
         jumps = []  # array for jmp instructions
         cmpsmovs = []   # array for cmp and mov instructions
         allinstr = []   # all instructions' addresses and their size in bytes
+        leaders = set() # first instructions of basic blocks: branch targets and instructions after a branch
         for section in elffile.iter_sections():
             ops = section.data()
             addr = section['sh_addr']   # section start address
@@ -122,16 +268,27 @@ def extract_arm_instructions(infile):
             file_offset = addr - offset
             name = section.name
             md = Cs(CS_ARCH_ARM, CS_MODE_ARM)
+            md.detail = True
             # below code finds and parses only certain elf sections
             # this is consistent with "objdump -S binary" command output
             if name == ".rodata": parsing = False
             elif name == ".init" or parsing:
                 parsing = True
-                for i in md.disasm(ops, addr):
+                for i in chain.from_iterable(md.disasm(chunk, start)
+                                             for chunk, start in scope_chunks(ops, addr, include, exclude)):
                     # determine the heap range
                     if i.address < startAddress: startAddress=i.address
                     if i.address > endAddress: endAddress=i.address
-                    allinstr.append({'addr':i.address-file_offset, 'size':i.size})
+                    allinstr.append({'addr':i.address-file_offset, 'size':i.size,
+                        'executed':executed is None or i.address in executed})
+                    if i.group(CS_GRP_JUMP) or i.group(CS_GRP_CALL):
+                        if i.operands and i.operands[0].type == ARM_OP_IMM:
+                            leaders.add(i.operands[0].imm - file_offset)
+                    # branches, returns and loads of pc, but not calls
+                    if not i.group(CS_GRP_CALL) and ARM_REG_PC in i.regs_access()[1]:
+                        leaders.add(i.address - file_offset + i.size)
+                    if not allinstr[-1]['executed']:
+                        continue
                     # determine the instruction type and parse accordingly
                     if i.mnemonic in branch_instr:  # select only branch instructions
                         if len(i.op_str)>4: # process proper jump addresses and ignore registers
@@ -153,136 +310,196 @@ def extract_arm_instructions(infile):
                             elif len(val)<=6: # '0x' + 2 bytes
                                 size = 2
                             cmpsmovs.append({'type':i.mnemonic,'size':size,'loc':loc})
+        mark_blocks(allinstr, leaders)
         return allinstr, jumps, cmpsmovs
     except ELFError:
         logging.info("%s is invalid elf file" % elffile)
 
-def inject_jump_faults(jumps,allinstr,infile,arch):
+def binary_key(infile, *params):
+    # cache key of what is derived from a binary: its content and the
+    # parameters of the derivation
+    with open(infile, 'rb') as file:
+        key = hashlib.sha256(file.read())
+    key.update(repr((CACHE_VERSION,) + params).encode())
+    return key.hexdigest()
+
+def load_cache(cache_dir, key):
+    # cached data as compact gzipped JSON, None if it is not cached
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, key + '.json.gz')
+    try:
+        with gzip.open(path, 'rt') as file:
+            data = json.load(file)
+        print("Loaded from the cache", path, "\n")
+        return data
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        print("Ignoring the invalid cache file", path, "\n")
+        return None
+
+def save_cache(cache_dir, key, data):
+    if cache_dir is None:
+        return
+    path = os.path.join(cache_dir, key + '.json.gz')
+    try:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        # written next to its final name and renamed, concurrent campaigns
+        # never read a partial file
+        with gzip.open(path + '.%d' %os.getpid(), 'wt') as file:
+            json.dump(data, file, separators=(',',':'))
+        os.replace(path + '.%d' %os.getpid(), path)
+    except OSError as e:
+        print("Warning: could not write the cache file", path, ":", e)
+
+def extract_instructions(infile, arch, executed=None, include=None, exclude=None, cache_dir=None):
+    # the extracted instructions are cached under a key of the binary, the
+    # capstone architecture and mode, and the selection of the instructions
+    mode = capstone_mode(infile, arch)
+    key = binary_key(infile, 'disassembly', arch, mode, include, exclude,
+                     sorted(executed) if executed is not None else None)
+    cached = load_cache(cache_dir, key)
+    if cached is not None:
+        allinstr = [{'addr':addr, 'size':size, 'executed':bool(run), 'block':bool(block)}
+                    for addr, size, run, block in cached['allinstr']]
+        jumps = [{'type':type, 'from':jumpfrom, 'to':jumpto} for type, jumpfrom, jumpto in cached['jumps']]
+        cmpsmovs = [{'type':type, 'size':size, 'loc':loc} for type, size, loc in cached['cmpsmovs']]
+        return allinstr, jumps, cmpsmovs
+    if arch=='x86':
+        allinstr, jumps, cmpsmovs = extract_x86_instructions(infile, executed, include, exclude)
+    elif arch=='arm':
+        allinstr, jumps, cmpsmovs = extract_arm_instructions(infile, executed, include, exclude)
+    save_cache(cache_dir, key, {'allinstr':[[i['addr'], i['size'], int(i['executed']), int(i['block'])]
+                                            for i in allinstr],
+                                'jumps':[[j['type'], j['from'], j['to']] for j in jumps],
+                                'cmpsmovs':[[c['type'], c['size'], c['loc']] for c in cmpsmovs]})
+    return allinstr, jumps, cmpsmovs
+
+def generate_jump_faults(jumps,allinstr,infile,arch,targets='all',functions=None,distance=None):
     # General configuration
     config = ExecConfig(os.path.expanduser(infile), None, arch, None) # None for outfile and wordsize
-    # prepare the fault models
-    fm_list = []
-    jump_targets = [j['to'] for j in jumps]
-    jump_targets = list(dict.fromkeys(jump_targets)) # remove duplicates
-    # try valid jump targets from the existing ones
-    # for jump in jumps:
-    #     for target in jump_targets:
-    #         if target!=jump['to']:
-    #             try:
-    #                 if jump['type'] == ('jmp' or 'b'):
-    #                     fault = {'type':jump['type'],'at':jump['from'],
-    #                         'from':jump['to'],'to':target,
-    #                         'fault':JMP(config, [jump['from'],target])}
-    #                 else:
-    #                     fault = {'type':jump['type'],'at':jump['from'],
-    #                         'from':jump['to'],'to':target,
-    #                         'fault':JBE(config, [jump['from'],target])}
-    #                 fm_list.append(fault)
-    #             except SystemExit:
-    #                 pass # skip targets causing out of range erors and move on
-    # try setting jump targets to all possible instruction addresses
-    # this includes jumping in the middle of an instruction
+    # prepare the fault models lazily, one at a time
+    count = 0
+    # the targets are every byte of the instructions (all), the instructions
+    # or the basic blocks, sorted to select the targets in reach of a jump at once
+    targets = sorted((i['addr']+offset, offset>0) for i in allinstr if targets != 'blocks' or i['block']
+                     for offset in range(0,i['size'] if targets == 'all' else 1))
+    addrs = [addr for addr, middle in targets]
+    starts = [start for start, end in functions or []]
     for jump in jumps:
-        for target in allinstr:
-            if target['addr']!=jump['to']:
-                try:
-                    for offset in range(0,target['size']):
-                        loc = hex(target['addr']+offset)
-                        if jump['type'] == ('jmp' or 'b'):
-                            if offset>0:
-                                type = jump['type'] + '_middlejmp'
-                                print(type)
-                                fault = {'type':type,'at':jump['from'],
-                                    'from':jump['to'],'to':loc,
-                                    'fault':JMP(config,[jump['from'],loc])}
-                            else:
-                                fault = {'type':jump['type'],'at':jump['from'],
-                                    'from':jump['to'],'to':loc,
-                                    'fault':JMP(config,[jump['from'],loc])}
-                        else:
-                            if offset>0:
-                                type = jump['type'] + '_middlejmp'
-                                fault = {'type':type,'at':jump['from'],
-                                    'from':jump['to'],'to':loc,
-                                    'fault':JBE(config,[jump['from'],loc])}
-                            else:
-                                fault = {'type':jump['type'],'at':jump['from'],
-                                    'from':jump['to'],'to':loc,
-                                    'fault':JBE(config, [jump['from'],loc])}
-                        fm_list.append(fault)
-                except SystemExit:
-                    pass # skip targets causing out of range erors and move on
+        model = JMP if jump['type'] == 'jmp' else JBE
+        original = int(jump['to'],0)
+        try:
+            # decode the encoding of the jump once, with its original target
+            proto = model(config,[jump['from'],jump['to']])
+        except SystemExit:
+            continue # unknown opcode or target outside the file
+        # the displacement is relative to the end of the jump (x86) or to the
+        # jump + 8 (ARM) and its range depends on the encoding
+        base = original - proto.target
+        low, high = DISPLACEMENTS[proto.type]
+        low, high = max(0, base + low), min(config.size, base + high)
+        at = int(jump['from'],0)
+        if distance is not None:
+            low, high = max(low, at - distance), min(high, at + distance + 1)
+        if functions:
+            # the function of the jump, jumps outside of any function are not limited
+            function = bisect_left(starts, at + 1) - 1
+            if function >= 0 and at < functions[function][1]:
+                low, high = max(low, functions[function][0]), min(high, functions[function][1])
+        first = bisect_left(addrs, low)
+        last = bisect_left(addrs, high)
+        for loc, middle in targets[first:last]:
+            if loc == original:
+                continue
+            if proto.type == 3 and (loc - base) % 4:
+                continue # ARM branches only reach whole words
+            fault = copy(proto)
+            fault.target = loc - base
+            fault.args = [jump['from'],hex(loc)]
+            type = jump['type'] + '_middlejmp' if middle else jump['type']
+            fault = {'type':type,'at':jump['from'],'from':jump['to'],'to':hex(loc),'fault':fault}
+            fault['name'] = '%s_at_%s_from_%s_to_%s' %(fault['type'],
+                fault['at'],fault['from'],fault['to'])
+            count += 1
+            yield fault
 
     print("Number of detected jumps: ", len(jumps))
-    print("Number of new binaries with changed jumps: ", len(fm_list))
-    # create a folder for faulted binaries
-    Path("faulted-binaries").mkdir(parents=True, exist_ok=True)
-    # Duplicate the input and then apply the faults
-    for f in fm_list:
-        outfile = 'faulted-binaries/%s_at_%s_from_%s_to_%s' %(f['type'],
-        f['at'],f['from'],f['to'])
-        shutil.copy(infile,outfile)
-        with open(outfile, "r+b") as file:
-            f['fault'].apply(file)
+    print("Number of new binaries with changed jumps: ", count)
 
-def inject_zero_faults(targets,infile,arch):
-    # prepare the fault models
-    fm_list = []
+def generate_zero_faults(targets,infile,arch):
+    # prepare the fault models lazily, one at a time
+    count = 0
+    configs = {}    # one config (and one read of the input) per word size
     for target in targets:
         try:
             if target['size'] == 1:
-                config = ExecConfig(os.path.expanduser(infile), None, arch, None) # None for outfile and wordsize
-                fault = {'type':target['type'], 'loc':target['loc'], 'fault':Z1B(config,[target['loc']])}
-                fm_list.append(fault)
+                if None not in configs:
+                    configs[None] = ExecConfig(os.path.expanduser(infile), None, arch, None) # None for outfile and wordsize
+                fault = {'type':target['type'], 'loc':target['loc'], 'fault':Z1B(configs[None],[target['loc']])}
             else:
-                config = ExecConfig(os.path.expanduser(infile), None, arch, target['size'])
-                fault = {'type':target['type'], 'loc':target['loc'], 'fault':Z1W(config,[target['loc']])}
-                fm_list.append(fault)
+                if target['size'] not in configs:
+                    configs[target['size']] = ExecConfig(os.path.expanduser(infile), None, arch, target['size'])
+                fault = {'type':target['type'], 'loc':target['loc'], 'fault':Z1W(configs[target['size']],[target['loc']])}
+            fault['name'] = '%s_at_%s_zeroed' %(fault['type'],fault['loc'])
+            count += 1
+            yield fault
         except SystemExit:
             pass # skip targets causing out of range erors and move on
     # print("Number of locations to zero: ", len(targets))
-    print("Number of new binaries with zeroed values: ", len(fm_list))
-    # create a folder for faulted binaries
-    Path("faulted-binaries").mkdir(parents=True, exist_ok=True)
-    # Duplicate the input and then apply the faults
-    for f in fm_list:
-        outfile = 'faulted-binaries/%s_at_%s_zeroed' %(f['type'],f['loc'])
-        shutil.copy(infile,outfile)
-        with open(outfile, "r+b") as file:
-            f['fault'].apply(file)
+    print("Number of new binaries with zeroed values: ", count)
 
-def inject_nop_faults(targets, infile, arch):
+def generate_nop_faults(targets, infile, arch):
     # prepare the fault models
-    fm_list = []
+    config = ExecConfig(os.path.expanduser(infile), None, arch, None) # None for outfile and wordsize
+    count = 0
     for target in targets:
         try:
-            config = ExecConfig(os.path.expanduser(infile), None, arch, None) # None for outfile and wordsize
             addr_from = target['addr']
             addr_till = target['addr'] + target['size'] - 1
             noprange = hex(addr_from) + '-' + hex(addr_till)
             # print("From %x till %x = Range %s" %(addr_from,addr_till,range))
             fault = {'range':noprange, 'fault':NOP(config,[noprange])}
-            fm_list.append(fault)
+            fault['name'] = 'nop_%s' %fault['range']
+            count += 1
+            yield fault
         except SystemExit:
             pass # skip targets causing out of range erors and move on
     # print("Number of instructions to be NOPed: ", len(targets))
-    print("Number of new binaries with NOPed instructions: ", len(fm_list))
-    # create a folder for faulted binaries
-    Path("faulted-binaries").mkdir(parents=True, exist_ok=True)
-    # Duplicate the input and then apply the faults
-    for f in fm_list:
-        outfile = 'faulted-binaries/nop_%s' %f['range']
-        shutil.copy(infile,outfile)
-        with open(outfile, "r+b") as file:
-            f['fault'].apply(file)
+    print("Number of new binaries with NOPed instructions: ", count)
+
+def predict_flip(md, data, addr, original):
+    # outcome of an instruction with a flipped bit that is certain without
+    # running it, None if it has to be run
+    flipped = next(md.disasm(data, addr, 1), None)
+    if flipped is None or flipped.mnemonic in UNDEFINED:
+        return 'crash:SIGILL'
+    if flipped.size != original.size:
+        return None # the next instructions are decoded differently
+    if (flipped.mnemonic, flipped.op_str) == (original.mnemonic, original.op_str):
+        return 'identical'  # another encoding of the same instruction
+    if flipped.mnemonic in NOPS and original.mnemonic in NOPS:
+        return 'identical'
+    return None
 
-def inject_flp_faults(targets, infile, arch):
+def generate_flp_faults(targets, infile, arch, predict=False, check=0):
     # prepare the fault models
-    fm_list = []
+    config = ExecConfig(os.path.expanduser(infile), None, arch, None) # None for outfile and wordsize
+    count = 0
+    predicted = Counter()
+    if predict:
+        # the flipped instructions are decoded again to predict the invalid
+        # opcodes and the flips that do not change the instruction
+        md = Cs(*capstone_mode(infile, arch))
     for target in targets:
         try:
-            config = ExecConfig(os.path.expanduser(infile), None, arch, None) # None for outfile and wordsize
             addr_from = target['addr']
+            if predict:
+                code = bytearray(config.data[addr_from:addr_from+16])
+                original = next(md.disasm(bytes(code), addr_from, 1), None)
+                if original is not None and original.size != target['size']:
+                    original = None # not an instruction boundary in the mode of the binary
             for offset in range(0,target['size']):
                 loc = hex(addr_from+offset)
 
@@ -294,82 +511,816 @@ def inject_flp_faults(targets, infile, arch):
                 # or with varied significance bit
                 for sgnf in range(0,8):
                     fault = {'loc':loc, 'sgnf':sgnf, 'fault':FLP(config,[loc,sgnf])}
-                    fm_list.append(fault)
+                    fault['name'] = 'flp_at_%s_sgnf_%d' %(fault['loc'],fault['sgnf'])
+                    if predict and original is not None:
+                        code[offset] ^= 1 << sgnf
+                        outcome = predict_flip(md, bytes(code), addr_from, original)
+                        code[offset] ^= 1 << sgnf
+                        if outcome is not None:
+                            fault['predicted'] = outcome
+                            predicted[outcome] += 1
+                            # a sample of the predicted faults is run to check the predictions
+                            fault['check'] = int(hashlib.sha256(fault['name'].encode()).hexdigest()[:8], 16) < check * 2**32
+                    count += 1
+                    yield fault
         except SystemExit:
             pass # skip targets causing out of range erors and move on
     # print("Number of instructions to be FLPed: ", len(targets))
-    print("Number of new binaries with FLPed instructions: ", len(fm_list))
-    # create a folder for faulted binaries
-    Path("faulted-binaries").mkdir(parents=True, exist_ok=True)
-    # Duplicate the input and then apply the faults
+    print("Number of new binaries with FLPed instructions: ", count)
+    for outcome, n in sorted(predicted.items()):
+        print("Number of FLPed binaries predicted %s: " %outcome, n)
+
+def generate_multi_faults(faults, allinstr, infile, arch, order, distance=None, same_block=False):
+    # combinations of order faults editing disjoint bits, at most distance
+    # bytes apart and/or in the same basic block
+    config = ExecConfig(os.path.expanduser(infile), None, arch, None) # None for outfile and wordsize
+    # the faults sorted by their [start, end) interval of edited bits
+    base = []
+    for f in faults:
+        ranges = f['fault'].edited_ranges()
+        base.append((min(start for start, end in ranges), max(end for start, end in ranges), f))
+    base.sort(key=lambda b: (b[0], b[1]))
+    starts = [b[0] for b in base]
+    leaders = sorted(i['addr'] for i in allinstr if i['block'])
+    def block(bit):
+        return bisect_right(leaders, bit // 8)
+    def extend(combination):
+        if len(combination) == order:
+            yield combination
+            return
+        first = base[combination[0]]
+        # the combined faults are disjoint and sorted, the next one starts
+        # after the end of the last one
+        for j in range(bisect_left(starts, base[combination[-1]][1]), len(base)):
+            start = base[j][0]
+            if distance is not None and start // 8 - first[0] // 8 > distance:
+                break
+            if same_block and block(start) != block(first[0]):
+                break
+            yield from extend(combination + [j])
+    count = 0
+    for i in range(len(base)):
+        for combination in extend([i]):
+            combined = [base[j][2] for j in combination]
+            types = [f['type'] for f in combined if f.get('type') is not None]
+            fault = {'fault':MULTI(config, [f['fault'] for f in combined]),
+                     'name':'+'.join(f['name'] for f in combined),
+                     'type':'+'.join(types) if types else None}
+            count += 1
+            yield fault
+    print("Number of new binaries with %d faults: " %order, count)
+
+def deduplicate_faults(faults, original):
+    # faults that produce the same image as an earlier fault are not run again,
+    # they are marked with the name of the first one and get its results
+    images = {}     # hash of the bytes changed by a fault -> name of its first fault
+    count = 0
+    for f in faults:
+        patched = {}
+        for offset, value in f['fault'].patches(original):
+            for i, b in enumerate(value, offset):
+                patched[i] = b
+        # patched bytes equal to the original ones do not change the image
+        changed = sorted((i, b) for i, b in patched.items() if original[i] != b)
+        image = hashlib.sha256(repr(changed).encode()).digest()[:16]
+        if image not in images:
+            images[image] = f['name']
+        elif images[image] == f['name']:
+            continue    # the same fault generated twice
+        else:
+            f['same_as'] = images[image]
+            count += 1
+        yield f
+    print("Number of faults with the same image as another fault: ", count)
+
+
+def select_staging(exec_mode):
+    # returns the folder the faulty binaries are written to, or None when they
+    # are kept in anonymous memory files (memfd) and never touch any filesystem
+    if exec_mode == 'memfd':
+        try:
+            os.close(os.memfd_create('chaosduck', os.MFD_CLOEXEC))
+            return None
+        except (AttributeError, OSError):    # Python < 3.8 or kernel < 3.17
+            print("memfd is not available, falling back to tmpfs\n")
+            exec_mode = 'tmpfs'
+    if exec_mode == 'tmpfs':
+        if os.path.isdir('/dev/shm'):
+            return '/dev/shm/chaosduck-%d' %os.getpid()
+        print("/dev/shm is not available, falling back to disk\n")
+    return 'faulted-binaries'
+
+def write_faulty_binaries(fm_list,original,mode,stagedir):
+    # patch a reusable scratch copy of the input for each fault instead of
+    # copying the whole file and seeking into the copy every time
+    image = bytearray(original)
+    for f in fm_list:
+        patches = f['fault'].patches(original)
+        for offset, value in patches:
+            image[offset:offset+len(value)] = value
+        if stagedir is None:
+            # the workers exec the memfd through the /proc link of this process
+            fd = os.memfd_create(f['name'], os.MFD_CLOEXEC)
+            f['fd'] = fd
+            f['path'] = '/proc/%d/fd/%d' %(os.getpid(),fd)
+            with open(fd, 'wb', closefd=False) as file:
+                file.write(image)
+        else:
+            f['path'] = '%s/%s' %(stagedir,f['name'])
+            fd = os.open(f['path'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+            with open(fd, 'wb') as file:
+                file.write(image)   # single bulk write per faulty binary
+        # restore the original bytes before the next fault is applied
+        for offset, value in patches:
+            image[offset:offset+len(value)] = original[offset:offset+len(value)]
+
+def remove_faulty_binaries(fm_list):
     for f in fm_list:
-        outfile = 'faulted-binaries/flp_at_%s_sgnf_%d' %(f['loc'],f['sgnf'])
-        shutil.copy(infile,outfile)
-        with open(outfile, "r+b") as file:
-            f['fault'].apply(file)
+        if 'fd' in f:
+            os.close(f.pop('fd'))
+        else:
+            try:
+                os.remove(f['path'])
+            except FileNotFoundError:
+                pass    # the same fault name may appear twice in a window
+
+def execute_task(execute, task):
+    # run one faulty binary with one test vector in a worker of the pool
+    binary, key, plaintext, timeout = task
+    start = time.monotonic()
+    res = execute(key, plaintext, binary, timeout)
+    # the modes with a setup on the first run (fork servers, emulator) time the run themselves
+    res.setdefault('elapsed', time.monotonic() - start)
+    res['key'] = key
+    res['plaintext'] = plaintext
+    return res
+
+async def execute_tasks_async(execute, tasks, jobs, record):
+    # run the tasks as subprocesses of a single event loop, at most jobs at a time
+    semaphore = asyncio.Semaphore(jobs)
+    async def execute_task_async(task):
+        binary, key, plaintext, timeout = task
+        async with semaphore:
+            start = time.monotonic()
+            res = await execute(key, plaintext, binary, timeout)
+            res['elapsed'] = time.monotonic() - start
+        res['key'] = key
+        res['plaintext'] = plaintext
+        return res
+    for future in asyncio.as_completed([execute_task_async(task) for task in tasks]):
+        record(await future)
+
+def run_tasks(tasks,record,execute,pool,jobs,chunksize):
+    # the results are recorded as soon as they are available whatever their order
+    if pool is None:
+        asyncio.run(execute_tasks_async(execute, tasks, jobs, record))
+    else:
+        for res in pool.imap_unordered(partial(execute_task, execute), tasks, chunksize):
+            record(res)
+
+def golden_run(original,execute,pool,jobs,chunksize,timeout,timeout_factor):
+    # run the original binary on every test vector to get the reference output
+    # of each vector and to derive its timeout from the slowest of its runs
+    golden = {}
+    def record(res):
+        vector = (res['key'],res['plaintext'])
+        if res['timedout'] or res['exitcode'] != 0:
+            print("Warning: the original binary failed on", res['key'], res['plaintext'])
+        if res.get('truncated'):
+            print("Warning: the output of the original binary is longer than --max-output on", res['key'], res['plaintext'])
+        if vector not in golden:
+            golden[vector] = {'stdout':res['stdout'],'exitcode':res['exitcode'],'elapsed':0}
+        elif (golden[vector]['stdout'],golden[vector]['exitcode']) != (res['stdout'],res['exitcode']):
+            print("Warning: the output of the original binary varies on", res['key'], res['plaintext'])
+        golden[vector]['elapsed'] = max(golden[vector]['elapsed'], res['elapsed'])
+    tasks = [(original,key,plaintext,timeout) for key in KEYS for plaintext in PLAINTEXTS] * GOLDEN_RUNS
+    run_tasks(tasks,record,execute,pool,jobs,chunksize)
+    for vector, ref in golden.items():
+        if timeout_factor > 0:
+            ref['timeout'] = min(timeout, max(MIN_TIMEOUT, ref['elapsed'] * timeout_factor))
+        else:
+            ref['timeout'] = timeout
+        print("Timeout for %s %s: %.3f sec (original binary: %.3f sec)" %(vector[0],vector[1],ref['timeout'],ref['elapsed']))
+    return golden
 
-def run_faulty_binaries(infile,arch):
+def classify(res, ref):
+    # outcome of a run compared to the run of the original binary with the same test vector
+    if res['timedout']:
+        return 'timeout'
+    if res['exitcode'] is not None and res['exitcode'] < 0:
+        try:
+            return 'crash:' + signal.Signals(-res['exitcode']).name
+        except ValueError:
+            return 'crash:%d' %-res['exitcode']
+    # the plaintext printed instead of the cipher
+    if b''.join(b'0x%02x ' %b for b in hex_to_bytes(res['plaintext'])) in res['stdout']:
+        return 'leak'
+    if res['stdout'] == ref['stdout'] and res['exitcode'] == ref['exitcode']:
+        return 'identical'
+    return 'different'
+
+def run_faulty_binaries(faulty_binaries_list,record,execute,pool,jobs,chunksize,golden,on_hang,done):
+    # every (faulty binary, test vector) pair is a task, except the ones done
+    # by a previous launch of the campaign
+    vectors = [(key,plaintext) for key in KEYS for plaintext in PLAINTEXTS]
+    hung = set()
+    def record_first(res):
+        if res['timedout']:
+            hung.add(res['filename'])
+        record(res)
+    if on_hang == 'run':
+        tasks = ((binary,key,plaintext,golden[(key,plaintext)]['timeout']) for key, plaintext in vectors
+                 for binary in faulty_binaries_list if (binary[0],key,plaintext) not in done)
+        run_tasks(tasks,record,execute,pool,jobs,chunksize)
+        return
+    # the binaries that hang with the first test vector most likely hang with
+    # the others: they are skipped or get a short timeout for the other vectors
+    key, plaintext = vectors[0]
+    tasks = []
+    for binary in faulty_binaries_list:
+        if (binary[0],key,plaintext) not in done:
+            tasks.append((binary,key,plaintext,golden[(key,plaintext)]['timeout']))
+        elif done[(binary[0],key,plaintext)] == 'timeout':
+            hung.add(binary[0])
+    run_tasks(tasks,record_first,execute,pool,jobs,chunksize)
+    tasks = []
+    for key, plaintext in vectors[1:]:
+        ref = golden[(key,plaintext)]
+        for binary in faulty_binaries_list:
+            if (binary[0],key,plaintext) in done:
+                continue
+            if binary[0] not in hung:
+                tasks.append((binary,key,plaintext,ref['timeout']))
+            elif on_hang == 'shorten':
+                tasks.append((binary,key,plaintext,min(max(MIN_TIMEOUT, 2 * ref['elapsed']), ref['timeout'])))
+            else:
+                record({'filename':binary[0],'key':key,'plaintext':plaintext,'stdout':b'',
+                    'stderr':b'skipped after a timeout with the first test vector\n','exitcode':None,
+                    'timedout':True})
+    run_tasks(tasks,record,execute,pool,jobs,chunksize)
+
+def run_campaign(faults,infile,window,exec_mode,execute,executor,jobs,chunksize,timeout,timeout_factor,on_hang,
+                 full_output=False,output='results.db',restart=False,observe=None,coordinator=None,selection=None):
+    # faults are enumerated lazily and only a window of them is materialized
+    # at a time: generated, executed, recorded and then deleted
     print("\nRunning the faulty binaries and recording the results...\n")
     print("This may take a while...\n")
-    keys = ["00010203040506070809","01234567890987654321","deadbeafdeadc0debabe"]
-    plaintexts = ["badf00dbadc0ffee","deadbeafbabec0de","1ceb00dab10sf00d"]
-    with open('results.csv', 'w') as csvfile:
-        writer = csv.writer(csvfile, delimiter=',')
-        faulty_binaries_list = os.listdir("faulted-binaries")
-        batchsize = 1000 # execute files in batches of 1000
-        for key in keys:
-            for plaintext in plaintexts:
-                print("Using key %s and plaintext %s" %(key,plaintext))
-                # function to run the faulty binaries
-                func = partial(execute_file, key, plaintext, arch)  # hack to pass more than 1 argument to execute_file function
-                for i in range(0, len(faulty_binaries_list), batchsize):
-                    batch = faulty_binaries_list[i:i+batchsize]
-                    with Pool(processes=50) as pool:
-                        results = pool.imap(func, batch)
-                        pool.close()
-                        for res in results:
-                            # if '0xba 0xdf 0x00 0xdb 0xad 0xc0 0xff 0xee' in res['stdout']:
-                            # if b'0xba 0xdf 0x00 0xdb 0xad 0xc0 0xff 0xee' in res['stdout']:
-                                # print("BINGO! Plaintext instead of cipher in",res['filename'])
-                            writer.writerow([infile,res['filename'],key,plaintext,res['stdout'],res['stderr'],
-                                res['exitcode'],res['timedout']])
-
-
-def execute_file(key, plaintext, arch, filename):
+    with open(infile, 'rb') as file:
+        original = file.read()
+    mode = os.stat(infile).st_mode & 0o777  # keep the input executable bits
+    # the workers of a distributed campaign get the patches of the faults
+    in_memory = exec_mode in ('forkserver', 'emulate') or executor == 'remote'
+    if in_memory:
+        stagedir = None # the faults are applied in memory to forks or emulations of the original binary
+    else:
+        stagedir = select_staging(exec_mode)
+        if stagedir is None:
+            # every faulty binary of the window is an open memfd
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            needed = window + 64
+            if hard != resource.RLIM_INFINITY and hard < needed:
+                sys.exit("The window is too large for the open files limit (%d), use a smaller one" %hard)
+            if soft != resource.RLIM_INFINITY and soft < needed:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+        else:
+            # create a folder for faulted binaries
+            Path(stagedir).mkdir(parents=True, exist_ok=True)
+    # the journal of the campaign lists the runs already stored, a campaign
+    # launched again with the same binary and the same selection of faults
+    # continues where it stopped
+    campaign = '%s %s %s' %(os.path.basename(infile), hashlib.sha256(original).hexdigest(),
+                            hashlib.sha256(repr(sorted((selection or {}).items())).encode()).hexdigest()[:16])
+    try:
+        journal = Journal(output + '.journal', campaign, restart)
+    except ValueError as e:
+        sys.exit(str(e))
+    done = journal.done
+    # the faults are deduplicated before the completed ones are dropped, so that
+    # the first fault of every image is known
+    faults = deduplicate_faults(faults, original)
+    if journal.resumed:
+        print("Resuming the campaign, %d runs already done\n" %len(done))
+        faults = (f for f in faults
+                  if not all((f['name'],key,plaintext) in done for key in KEYS for plaintext in PLAINTEXTS))
+    if observe is not None:
+        # the outcomes of a sampled campaign include the runs of the previous launches
+        for (name, key, plaintext), outcome in done.items():
+            observe(name, outcome)
+    store = open_store(output, journal.resumed)
+    # a single pool of workers for the whole campaign, none with the asyncio
+    # executor, and the workers connected to the coordinator when distributed
+    if executor == 'pool':
+        workers = Pool(processes=jobs)
+    elif executor == 'remote':
+        workers = coordinator
+    else:
+        workers = nullcontext()
+    with workers as pool:
+        if in_memory:
+            original_binary = (os.path.basename(infile),[])
+        else:
+            original_binary = (os.path.basename(infile),os.path.abspath(infile))
+        golden = golden_run(original_binary,execute,pool,jobs,chunksize,timeout,timeout_factor)
+        outcomes = Counter()
+        checks = Counter()  # predicted outcomes checked by running the fault, and the correct ones
+        fields = {}     # structured description of the faults of the window
+        def atomically(*steps):
+            # an interruption waits until all the steps are done
+            mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT, signal.SIGTERM})
+            try:
+                for step in steps:
+                    step()
+            finally:
+                signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        def checkpoint(close=False):
+            # the runs are stored before they are journaled, and an interruption
+            # waits until both are written
+            atomically(*((store.close, journal.close) if close else (store.flush, journal.flush)))
+        def record(res):
+            # each run is classified as it finishes, only the outputs of the
+            # findings are kept
+            if 'predicted' in res:
+                outcome = res['predicted']
+            else:
+                outcome = classify(res, golden[(res['key'],res['plaintext'])])
+                prediction = fields[res['filename']]['prediction']
+                if prediction is not None:
+                    checks['checked'] += 1
+                    checks['correct'] += outcome == prediction
+            outcomes[outcome] += 1
+            if outcome == 'leak':
+                print("BINGO! Plaintext instead of cipher in",res['filename'],res['key'],res['plaintext'])
+            run = dict(fields[res['filename']], infile=infile, key=res['key'], plaintext=res['plaintext'],
+                       outcome=outcome, exitcode=res['exitcode'], timedout=res['timedout'],
+                       truncated=res.get('truncated', False))
+            atomically(partial(store.add, run, res['stdout'], res['stderr'],
+                               full_output or outcome in ('different', 'leak')),
+                       partial(journal.add, res['filename'], res['key'], res['plaintext'], outcome))
+            if observe is not None:
+                observe(res['filename'], outcome)
+            if len(journal.pending) >= BATCH:
+                checkpoint()
+        def record_copy(f):
+            # a fault with the same image as an earlier one gets its runs, the copies
+            # are collected first and then added to the store and to the journal at once
+            run = dict(fields[f['name']], infile=infile)
+            copied = store.stored(f['same_as'])
+            def add():
+                store.copy(run, copied)
+                for key, plaintext, outcome, row in copied:
+                    journal.add(f['name'], key, plaintext, outcome)
+            atomically(add)
+            for key, plaintext, outcome, row in copied:
+                outcomes[outcome] += 1
+                if outcome == 'leak':
+                    print("BINGO! Plaintext instead of cipher in",f['name'],key,plaintext)
+                if observe is not None:
+                    observe(f['name'], outcome)
+            if len(journal.pending) >= BATCH:
+                checkpoint()
+        try:
+            run_windows(faults,window,in_memory,original,mode,stagedir,fields,record,record_copy,execute,pool,
+                jobs,chunksize,golden,on_hang,done)
+        finally:
+            # the runs recorded so far are kept, also when the campaign is interrupted
+            checkpoint(close=True)
+    if stagedir is not None and stagedir != 'faulted-binaries':
+        os.rmdir(stagedir)
+    print("\nOutcomes of the runs:")
+    for outcome, count in sorted(outcomes.items()):
+        print("%-16s %d" %(outcome, count))
+    if checks['checked']:
+        print("\nPredicted outcomes checked: %d, correct: %d (%.1f%%)"
+              %(checks['checked'], checks['correct'], 100 * checks['correct'] / checks['checked']))
+
+def run_windows(faults,window,in_memory,original,mode,stagedir,fields,record,record_copy,execute,pool,jobs,
+                chunksize,golden,on_hang,done):
+    while True:
+        fm_list = list(islice(faults, window))
+        if not fm_list:
+            break
+        fields.clear()
+        fields.update((f['name'],fault_fields(f)) for f in fm_list)
+        # only the first fault of each image is run, the others are copied once
+        # it has run (in this window or an earlier one)
+        copies = [f for f in fm_list if 'same_as' in f]
+        fm_list = [f for f in fm_list if 'same_as' not in f]
+        # the faults with a predicted outcome are not run, except a sample of them
+        predicted = [f for f in fm_list if 'predicted' in f and not f['check']]
+        fm_list = [f for f in fm_list if 'predicted' not in f or f['check']]
+        if in_memory:
+            binaries = [(f['name'],f['fault'].patches(original)) for f in fm_list]
+            run_faulty_binaries(binaries,record,execute,pool,jobs,chunksize,golden,on_hang,done)
+        else:
+            write_faulty_binaries(fm_list,original,mode,stagedir)
+            try:
+                binaries = [(f['name'],f['path']) for f in fm_list]
+                run_faulty_binaries(binaries,record,execute,pool,jobs,chunksize,golden,on_hang,done)
+            finally:
+                remove_faulty_binaries(fm_list)
+        for f in predicted:
+            for key in KEYS:
+                for plaintext in PLAINTEXTS:
+                    if (f['name'],key,plaintext) not in done:
+                        record({'filename':f['name'],'key':key,'plaintext':plaintext,'stdout':b'',
+                            'stderr':b'predicted from the disassembly, not run\n','exitcode':None,
+                            'timedout':False,'predicted':f['predicted']})
+        for f in copies:
+            record_copy(f)
+
+def file_command(arch, key, plaintext, path):
     if arch=='x86':
-        command = 'faulted-binaries/%s %s %s' %(filename,key,plaintext)
+        command = '%s %s %s' %(path,key,plaintext)
     elif arch=='arm':
-        command = 'qemu-arm -L /usr/arm-linux-gnueabi/ faulted-binaries/%s %s %s' %(filename,key,plaintext)
-    args = shlex.split(command)
-    # p = Popen(args,stdout=PIPE,stderr=PIPE,universal_newlines=True) # extract stdout in a textual utf-8 format
-    p = Popen(args,stdout=PIPE,stderr=PIPE) # extract stdout in a binary-like format
+        command = 'qemu-arm -L /usr/arm-linux-gnueabi/ %s %s %s' %(path,key,plaintext)
+    return shlex.split(command)
+
+def read_output(p, timeout, max_output):
+    # stream the stdout and stderr of a run, only the first max_output bytes
+    # of each are kept and the rest is read and dropped
+    outputs = {p.stdout.fileno(): bytearray(), p.stderr.fileno(): bytearray()}
+    timedout = truncated = False
+    deadline = time.monotonic() + timeout
+    with selectors.DefaultSelector() as selector:
+        for fd in outputs:
+            selector.register(fd, selectors.EVENT_READ)
+        while selector.get_map():
+            # after a kill the output is read until the pipes are closed
+            remaining = None if timedout else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                timedout = True
+                p.kill()
+                continue
+            for key, mask in selector.select(remaining):
+                data = os.read(key.fd, 1 << 16)
+                if not data:
+                    selector.unregister(key.fd)
+                    continue
+                output = outputs[key.fd]
+                if max_output is not None and len(output) + len(data) > max_output:
+                    truncated = True
+                    data = data[:max(0, max_output - len(output))]
+                output += data
     try:
-        outs, errs = p.communicate(timeout=3)   # 3 sec
-        # print(filename,outs,errs,p.returncode)
-        return({'filename':filename,'stdout':outs,'stderr':errs,
-            'exitcode':p.returncode,'timedout':False})
+        p.wait(None if timedout else max(0, deadline - time.monotonic()))
     except TimeoutExpired:
+        timedout = True
         p.kill()
-        outs, errs = p.communicate()
+        p.wait()
+    return bytes(outputs[p.stdout.fileno()]), bytes(outputs[p.stderr.fileno()]), timedout, truncated
+
+def execute_file(arch, limits, key, plaintext, binary, timeout):
+    filename, path = binary
+    args = file_command(arch, key, plaintext, path)
+    # p = Popen(args,stdout=PIPE,stderr=PIPE,universal_newlines=True) # extract stdout in a textual utf-8 format
+    p = Popen(args,stdout=PIPE,stderr=PIPE,preexec_fn=partial(set_limits, limits)) # extract stdout in a binary-like format
+    try:
+        outs, errs, timedout, truncated = read_output(p, timeout, limits.get('output'))
         # print(filename,outs,errs,p.returncode)
         return({'filename':filename,'stdout':outs,'stderr':errs,
-            'exitcode':p.returncode,'timedout':True})
+            'exitcode':p.returncode,'timedout':timedout,'truncated':truncated})
     finally:
         p.kill()
+        p.stdout.close()
+        p.stderr.close()
+
+async def read_output_async(stream, max_output):
+    # the first max_output bytes of an output, the rest is read and dropped
+    output = bytearray()
+    truncated = False
+    while True:
+        data = await stream.read(1 << 16)
+        if not data:
+            return bytes(output), truncated
+        if max_output is not None and len(output) + len(data) > max_output:
+            truncated = True
+            data = data[:max(0, max_output - len(output))]
+        output += data
+
+async def execute_file_async(arch, limits, key, plaintext, binary, timeout):
+    filename, path = binary
+    args = file_command(arch, key, plaintext, path)
+    p = await asyncio.create_subprocess_exec(*args, stdout=PIPE, stderr=PIPE, preexec_fn=partial(set_limits, limits))
+    # the output is read until the pipes are closed, also after a kill on timeout
+    max_output = limits.get('output')
+    run = asyncio.gather(read_output_async(p.stdout, max_output), read_output_async(p.stderr, max_output), p.wait())
+    done, pending = await asyncio.wait({run}, timeout=timeout)
+    timedout = not done
+    if timedout:
+        try:
+            p.kill()
+        except ProcessLookupError:
+            timedout = False    # exited after the timeout but before the kill
+    (outs, out_truncated), (errs, err_truncated), exitcode = await run
+    return({'filename':filename,'stdout':outs,'stderr':errs,
+        'exitcode':exitcode,'timedout':timedout,'truncated':out_truncated or err_truncated})
+
+def execute_patched(original, arch, stagedir, limits, key, plaintext, binary, timeout):
+    # a worker of a distributed campaign writes each faulty binary from the
+    # bytes of the original binary and the patches of the fault
+    filename, patches = binary
+    image = bytearray(original)
+    for offset, value in patches:
+        image[offset:offset+len(value)] = value
+    try:
+        fd = os.memfd_create(filename, os.MFD_CLOEXEC)
+        path = '/proc/%d/fd/%d' %(os.getpid(),fd)
+    except (AttributeError, OSError):
+        path = '%s/%d-%s' %(stagedir,os.getpid(),filename)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+    try:
+        with open(fd, 'wb', closefd=False) as file:
+            file.write(image)
+        if not path.startswith('/proc/'):
+            os.close(fd)
+            fd = None
+        return execute_file(arch, limits, key, plaintext, (filename, path), timeout)
+    finally:
+        if fd is not None:
+            os.close(fd)
+        else:
+            os.remove(path)
+
+forkservers = {}    # fork servers of a worker process, one per test vector
+
+def execute_forked(infile, arch, fork_at, limits, key, plaintext, binary, timeout):
+    filename, patches = binary
+    if (key,plaintext) not in forkservers:
+        if arch=='x86':
+            forkservers[(key,plaintext)] = ForkServer(infile, [key,plaintext], fork_at, limits)
+        elif arch=='arm':   # a single qemu-arm instance forked for every run
+            forkservers[(key,plaintext)] = QemuServer(infile, [key,plaintext], fork_at, limits=limits)
+    # the startup of the fork server is not part of the run
+    start = time.monotonic()
+    res = forkservers[(key,plaintext)].run(patches, timeout)
+    res['elapsed'] = time.monotonic() - start
+    res['filename'] = filename
+    return res
+
+emulator = None     # emulator of a worker process, shared by all the test vectors
+
+def execute_emulated(infile, function, fnargs, max_instructions, key, plaintext, binary, timeout):
+    # the instruction limit of the emulator replaces the timeout
+    global emulator
+    filename, patches = binary
+    if emulator is None:
+        emulator = Emulator(infile, function, fnargs, max_instructions)
+    start = time.monotonic()
+    res = emulator.run(patches, key, plaintext)
+    res['elapsed'] = time.monotonic() - start
+    res['filename'] = filename
+    res['truncated'] = False    # the output buffers have a fixed size
+    return res
 
 def main(argv):
-    infile = argv[1]
-    arch = argv[2]
-    if arch=='x86':
-        allinstr, jumps, cmpsmovs = extract_x86_instructions(infile)
-    elif arch=='arm':
-        allinstr, jumps, cmpsmovs = extract_arm_instructions(infile)
+    parser = argparse.ArgumentParser(description='Fault injection campaign on a binary')
+    parser.add_argument('infile', type=str, help='path to the binary to fault')
+    parser.add_argument('arch', type=str, choices=['x86', 'arm'], help='architecture of the binary')
+    parser.add_argument('-w', '--window', type=int, default=1000,
+                        help='number of faulty binaries kept on disk at a time (default: 1000)')
+    parser.add_argument('-e', '--exec-mode', type=str, default='disk',
+                        choices=['disk', 'tmpfs', 'memfd', 'forkserver', 'emulate'],
+                        help='where the faulty binaries are executed from: faulted-binaries/ (disk), '
+                             '/dev/shm (tmpfs), anonymous memory files (memfd), patched forks of '
+                             'the original binary (or of its qemu-arm instance, experimental) stopped at '
+                             '--fork-at (forkserver) or an emulation of --function only (emulate) (default: disk)')
+    parser.add_argument('--fork-at', type=str, default='main', metavar='SYMBOL',
+                        help='symbol or address where the fork server stops the binary (default: main)')
+    parser.add_argument('--function', type=str, default='encryption', metavar='SYMBOL',
+                        help='symbol or address of the function run by the emulate mode (default: encryption)')
+    parser.add_argument('--function-args', type=str, default='plaintext,out:8,key', metavar='SPEC',
+                        help='pointer arguments of the emulated function, comma separated key, plaintext '
+                             'or out:SIZE output buffers printed as the result (default: plaintext,out:8,key)')
+    parser.add_argument('--max-instructions', type=int, default=1000000, metavar='N',
+                        help='instructions after which an emulated run is considered as hanging '
+                             '(default: 1000000)')
+    parser.add_argument('--include', type=str, action='append', metavar='FUNCTION|START-END',
+                        help='disassemble and fault only this function (from the symbol table or DWARF) '
+                             'or virtual address range, can be repeated (default: the whole code)')
+    parser.add_argument('--exclude', type=str, action='append', metavar='FUNCTION|START-END',
+                        help='do not disassemble nor fault this function or virtual address range, can be '
+                             'repeated')
+    parser.add_argument('--jump-targets', type=str, default='all', choices=['all', 'instructions', 'blocks'],
+                        help='new targets of the faulted jumps: every byte of every instruction (all), the '
+                             'first byte of every instruction (instructions) or the first instruction of every '
+                             'basic block (blocks) (default: all)')
+    parser.add_argument('--same-function', action='store_true',
+                        help='redirect the jumps only inside their function (from the symbol table)')
+    parser.add_argument('--jump-distance', type=int, metavar='BYTES',
+                        help='redirect the jumps only to targets at most this many bytes away')
+    parser.add_argument('--predict-flp', action='store_true',
+                        help='decode every bit-flipped instruction and record the outcome of the flips that '
+                             'give an invalid opcode (crash:SIGILL) or the same instruction (identical) '
+                             'instead of running them, requires --trace')
+    parser.add_argument('--check-predictions', type=float, default=0, metavar='FRACTION',
+                        help='fraction of the predicted bit flips that are run anyway to check the '
+                             'predictions (default: 0)')
+    parser.add_argument('--order', type=int, default=1, metavar='N',
+                        help='number of faults applied together to each faulty binary, the combinations of '
+                             'faults that do not edit the same bits (default: 1)')
+    parser.add_argument('--order-models', type=str, metavar='MODELS',
+                        help='comma separated fault models combined by --order, e.g. NOP,FLP (default: all)')
+    parser.add_argument('--order-distance', type=int, default=16, metavar='BYTES',
+                        help='combine only faults at most this many bytes apart (default: 16)')
+    parser.add_argument('--same-block', action='store_true',
+                        help='combine only faults in the same basic block')
+    parser.add_argument('--trace', action='store_true',
+                        help='trace the original binary with the test vectors (ptrace on x86, qemu-arm logs '
+                             'on ARM, experimental) and fault only the instructions it executes')
+    parser.add_argument('--cache-dir', type=str,
+                        default=os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                             'chaosduck'),
+                        help='folder of the cached disassembly and traces (default: ~/.cache/chaosduck)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disassemble (and trace) the binary even if it is cached, and do not cache it')
+    parser.add_argument('--sample', type=int, metavar='BUDGET',
+                        help='run at most this many faults, sampled at random by model, section and function, '
+                             'and report the success rate of each with a 95%% confidence interval')
+    parser.add_argument('--precision', type=float, metavar='HALF_WIDTH',
+                        help='stop sampling a model, section and function once the confidence interval of '
+                             'its success rate is this narrow, e.g. 0.05 (default: sample up to the budget)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random order of the sampled faults (default: 0)')
+    parser.add_argument('-x', '--executor', type=str, default='pool', choices=['pool', 'asyncio', 'remote'],
+                        help='run the faulty binaries from a pool of worker processes (pool), as '
+                             'subprocesses of a single event loop (asyncio, disk, tmpfs and memfd modes '
+                             'only) or on the workers (distributed.py) connected to --listen (remote) '
+                             '(default: pool)')
+    parser.add_argument('--listen', type=str, default='localhost:7654', metavar='HOST:PORT|unix:PATH',
+                        help='address the workers of the remote executor connect to (default: localhost:7654)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of worker processes (pool) or of faulty binaries running at a time '
+                             '(asyncio) (default: number of CPUs for pool, 16 per CPU for asyncio)')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='number of (faulty binary, test vector) runs sent to a worker at once (default: 16)')
+    parser.add_argument('-t', '--timeout', type=float, default=3,
+                        help='maximum time in seconds a faulty binary runs with a test vector (default: 3)')
+    parser.add_argument('--timeout-factor', type=float, default=10,
+                        help='the timeout of a test vector is this multiple of the time of the original '
+                             'binary, capped by --timeout, 0 always uses --timeout (default: 10)')
+    parser.add_argument('--max-output', type=int, default=1 << 20, metavar='BYTES',
+                        help='bytes of stdout and of stderr kept per run, the rest is dropped and the run is '
+                             'marked as truncated, 0 for no limit (default: 1048576). In the forkserver mode a '
+                             'run writing more is killed by SIGXFSZ')
+    parser.add_argument('--rlimit-cpu', type=int, metavar='SECONDS',
+                        help='CPU time limit of each run, a run exceeding it is killed by SIGXCPU')
+    parser.add_argument('--rlimit-as', type=int, metavar='MB',
+                        help='address space limit of each run (of qemu-arm for ARM binaries)')
+    parser.add_argument('--rlimit-fsize', type=int, metavar='MB',
+                        help='size limit of the files written by each run, a run exceeding it is killed by SIGXFSZ')
+    parser.add_argument('--rlimit-nproc', type=int, metavar='N',
+                        help='limit on the number of processes of the user running the campaign, checked when '
+                             'a run forks, so it must be above the processes of the campaign itself')
+    parser.add_argument('-o', '--output', type=str, default='results.db',
+                        help='file the results are stored in: an SQLite database, or a CSV file if the name '
+                             'ends with .csv (default: results.db)')
+    parser.add_argument('--full-output', action='store_true',
+                        help='store the output of every run, not only of the runs whose output differs '
+                             'from the original binary')
+    parser.add_argument('--on-hang', type=str, default='shorten', choices=['shorten', 'skip', 'run'],
+                        help='what happens to the other test vectors of a faulty binary that times out '
+                             'with the first one: run with a short timeout (shorten), not run and recorded '
+                             'as timed out (skip), or run as usual (run) (default: shorten)')
+    parser.add_argument('--restart', action='store_true',
+                        help='start the campaign over instead of resuming it from the journal of the output '
+                             '(OUTPUT.journal)')
+    args = parser.parse_args(argv[1:])
+    if args.window <= 0:
+        parser.error("window must be positive")
+    if args.executor == 'asyncio' and args.exec_mode in ('forkserver', 'emulate'):
+        parser.error("the asyncio executor only runs faulty binaries from files")
+    if args.jobs is None:
+        args.jobs = (os.cpu_count() or 1) * (16 if args.executor == 'asyncio' else 1)
+    if args.jobs <= 0:
+        parser.error("jobs must be positive")
+    if args.chunksize <= 0:
+        parser.error("chunksize must be positive")
+    if args.max_instructions <= 0:
+        parser.error("max-instructions must be positive")
+    if args.jump_distance is not None and args.jump_distance < 0:
+        parser.error("jump-distance must not be negative")
+    if args.order <= 0:
+        parser.error("order must be positive")
+    if args.order_distance < 0:
+        parser.error("order-distance must not be negative")
+    models = ['JMP', 'JBE', 'Z1B', 'Z1W', 'NOP', 'FLP']
+    if args.order_models is not None:
+        args.order_models = args.order_models.upper().split(',')
+        for model in args.order_models:
+            if model not in models:
+                parser.error("unknown fault model %s, the models are %s" %(model, ','.join(models)))
+    if args.order > 1 and args.predict_flp:
+        parser.error("predict-flp only applies to single faults")
+    if args.predict_flp and not args.trace:
+        # without a trace the instructions that never run would be predicted
+        parser.error("predict-flp requires --trace, a prediction assumes that the instruction runs")
+    if not 0 <= args.check_predictions <= 1:
+        parser.error("check-predictions must be between 0 and 1")
+    if args.sample is not None and args.sample <= 0:
+        parser.error("sample must be positive")
+    if args.precision is not None and not 0 < args.precision < 1:
+        parser.error("precision must be between 0 and 1")
+    if args.precision is not None and args.sample is None:
+        parser.error("precision requires --sample")
+    if args.timeout <= 0:
+        parser.error("timeout must be positive")
+    if args.timeout_factor < 0:
+        parser.error("timeout-factor must not be negative")
+    for name in ('max_output', 'rlimit_cpu', 'rlimit_as', 'rlimit_fsize', 'rlimit_nproc'):
+        value = getattr(args, name)
+        if value is not None and (value < 0 or value == 0 and name != 'max_output'):
+            parser.error("%s must be positive" %name.replace('_', '-'))
+    # resource limits of every run, by RLIMITS name, and the size of the output kept
+    limits = {'output':args.max_output or None, 'cpu':args.rlimit_cpu, 'nproc':args.rlimit_nproc,
+              'as':args.rlimit_as and args.rlimit_as << 20, 'fsize':args.rlimit_fsize and args.rlimit_fsize << 20}
+    infile = args.infile
+    arch = args.arch
+    if arch=='arm' and (args.trace or args.exec_mode == 'forkserver'):
+        print("Warning: the qemu-arm fork server and tracer are experimental, their results have not been "
+              "compared with the disk mode on a real qemu-arm yet\n")
+    if arch=='arm' and (args.trace or args.exec_mode == 'forkserver' and args.executor != 'remote'):
+        # the qemu-arm fork server and tracer only run with a supported qemu,
+        # the workers of a distributed campaign check their own
+        try:
+            check_qemu()
+        except RuntimeError as e:
+            parser.error(str(e))
+    if args.exec_mode == 'forkserver':
+        execute = partial(execute_forked, infile, arch, args.fork_at, limits)
+    elif args.exec_mode == 'emulate':
+        try:
+            fnargs = parse_args_spec(args.function_args)
+            Emulator(infile, args.function, fnargs, args.max_instructions)  # fail early on a wrong setup
+        except (ValueError, RuntimeError) as e:
+            parser.error(str(e))
+        execute = partial(execute_emulated, infile, args.function, fnargs, args.max_instructions)
+    elif args.executor == 'asyncio':
+        execute = partial(execute_file_async, arch, limits)
+    else:
+        execute = partial(execute_file, arch, limits)
+    coordinator = None
+    if args.executor == 'remote':
+        # the workers may join as soon as the coordinator listens, they get the
+        # original binary once and then the patches of every fault
+        with open(infile, 'rb') as file:
+            setup = {'name':os.path.basename(infile), 'binary':file.read(), 'arch':arch, 'exec_mode':args.exec_mode,
+                     'fork_at':args.fork_at, 'function':args.function, 'function_args':args.function_args,
+                     'max_instructions':args.max_instructions, 'limits':limits}
+        try:
+            coordinator = Coordinator(args.listen, setup)
+        except ValueError as e:
+            parser.error(str(e))
+        except OSError as e:
+            sys.exit("Cannot listen on %s: %s" %(args.listen, e))
+    try:
+        include = resolve_scope(infile, args.include) if args.include else None
+        exclude = resolve_scope(infile, args.exclude or [])
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    executed = None
+    if args.trace:
+        try:
+            executed = trace_binary(infile, arch, args.jobs, None if args.no_cache else args.cache_dir)
+        except (OSError, RuntimeError) as e:
+            sys.exit("Tracing failed: %s" %e)
+    allinstr, jumps, cmpsmovs = extract_instructions(infile, arch, executed, include, exclude,
+        None if args.no_cache else args.cache_dir)
     print("Number of detected instructions: ", len(allinstr))
-    inject_jump_faults(jumps,allinstr,infile,arch)
-    inject_zero_faults(cmpsmovs,infile,arch)
-    inject_nop_faults(allinstr,infile,arch)
-    inject_flp_faults(allinstr,infile,arch)
-    run_faulty_binaries(infile,arch)
+    # every instruction is a jump target, only the executed ones are faulted
+    targets = [i for i in allinstr if i['executed']]
+    functions = None
+    if args.same_function:
+        functions = function_ranges(infile, arch)
+        if not functions:
+            print("Warning: no function in the symbol table, the jumps are not limited to their function\n")
+    faults = chain(generate_jump_faults(jumps,allinstr,infile,arch,args.jump_targets,functions,args.jump_distance),
+        generate_zero_faults(cmpsmovs,infile,arch),
+        generate_nop_faults(targets,infile,arch),
+        generate_flp_faults(targets,infile,arch,args.predict_flp,args.check_predictions))
+    if args.order > 1:
+        if args.order_models is not None:
+            faults = (f for f in faults if f['fault'].name in args.order_models)
+        faults = generate_multi_faults(faults,allinstr,infile,arch,args.order,args.order_distance,args.same_block)
+    sampler = None
+    if args.sample is not None:
+        # the faults are all generated to be sampled, each window of the
+        # campaign is a round allocated with the outcomes of the previous ones
+        sampler = StratifiedSampler(faults, fault_strata(infile, arch), args.sample, args.precision,
+            args.window, len(KEYS) * len(PLAINTEXTS), args.seed)
+        print("Sampling at most %d of %d faults in %d strata\n"
+              %(args.sample, len(sampler.where), len(sampler.strata)))
+        faults = iter(sampler)
+    # the parameters that select the faults, a journal of other ones is not resumed
+    selection = {'include':include, 'exclude':exclude, 'trace':args.trace, 'jump_targets':args.jump_targets,
+                 'same_function':args.same_function, 'jump_distance':args.jump_distance,
+                 'predict_flp':args.predict_flp, 'check_predictions':args.check_predictions, 'order':args.order,
+                 'order_models':args.order_models, 'order_distance':args.order_distance,
+                 'same_block':args.same_block}
+    run_campaign(faults,infile,args.window,args.exec_mode,execute,args.executor,args.jobs,args.chunksize,
+        args.timeout,args.timeout_factor,args.on_hang,args.full_output,args.output,args.restart,
+        sampler.observe if sampler else None,coordinator,selection)
+    if sampler:
+        sampler.report()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,363 @@
+import os, sys, signal, json, time, base64, zlib, socket, selectors, tempfile, argparse, threading, traceback
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+
+# Protocol: one JSON object per line, in both directions.
+#   worker -> coordinator  {"type": "hello", "jobs": N}
+#   coordinator -> worker  {"type": "setup", "name": ..., "binary": zlib+base64, "arch": ..., "exec_mode": ...}
+#   coordinator -> worker  {"type": "tasks", "tasks": [[id, name, [[offset, hex bytes], ...], key, plaintext, timeout]]}
+#   worker -> coordinator  {"type": "result", "id": id, "result": {...stdout and stderr in base64...}}
+#   worker -> coordinator  {"type": "error", "id": id, "message": traceback of a failed task}
+#   coordinator -> worker  {"type": "done"}
+# A fault is sent as its patches, never as a faulty binary.
+
+CREDIT = 2  # chunks of tasks sent in advance to each worker process
+RUN_OVERHEAD = 1    # seconds a run may take beyond its timeout on a worker (startup, transfer)
+HANG_GRACE = 60     # seconds added to the deadline of every task, a worker late on one is dropped
+
+
+def parse_address(address):
+    """Returns the socket family and address of HOST:PORT or unix:PATH."""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError("Invalid address, HOST:PORT or unix:PATH expected : %s" %address)
+    return socket.AF_INET6 if ':' in host else socket.AF_INET, (host.strip('[]') or '0.0.0.0', int(port))
+
+
+def send(sock, message):
+    sock.sendall(json.dumps(message).encode() + b'\n')
+
+
+def encode_task(number, task):
+    (name, patches), key, plaintext, timeout = task
+    return [number, name, [[offset, value.hex()] for offset, value in patches], key, plaintext, timeout]
+
+
+def decode_task(task):
+    number, name, patches, key, plaintext, timeout = task
+    return number, ((name, [(offset, bytes.fromhex(value)) for offset, value in patches]), key, plaintext, timeout)
+
+
+def encode_result(res):
+    return dict(res, stdout=base64.b64encode(res['stdout']).decode(), stderr=base64.b64encode(res['stderr']).decode())
+
+
+def decode_result(res):
+    return dict(res, stdout=base64.b64decode(res['stdout']), stderr=base64.b64decode(res['stderr']))
+
+
+def valid(message):
+    # the messages a worker sends, with the fields the coordinator reads
+    if not isinstance(message, dict):
+        return False
+    if message.get('type') == 'hello':
+        return isinstance(message.get('jobs'), int) and message['jobs'] > 0
+    if message.get('type') == 'result':
+        return isinstance(message.get('id'), int) and isinstance(message.get('result'), dict)
+    if message.get('type') == 'error':
+        return isinstance(message.get('id'), int) and isinstance(message.get('message'), str)
+    return False
+
+
+class Connection:
+    """A worker connected to the coordinator, with the tasks sent to it and not returned yet."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+        self.jobs = 0       # known from its hello, no task is sent before
+        self.pending = {}   # id -> task
+        self.deadlines = {} # id -> time its result is expected by
+
+    def messages(self):
+        """Returns the messages received, raises ConnectionError if the worker left."""
+        data = self.sock.recv(1 << 16)
+        if not data:
+            raise ConnectionError("worker left")
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b'\n')
+        return [json.loads(line) for line in lines if line]
+
+
+class Coordinator:
+    """Runs the tasks of a campaign on the workers connected to a socket, in place of a pool of processes.
+
+    Workers may connect at any time, the tasks are sent to them in chunks. The tasks of a worker
+    that leaves, or that does not return a task by its deadline, are sent again to the others, and
+    the campaign waits while no worker is connected.
+    """
+
+    def __init__(self, address, setup):
+        """Listen for workers.
+
+        :param address: HOST:PORT or unix:PATH
+        :param setup: what the workers need to execute the tasks: the original binary and the execution mode
+        """
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)   # left by an earlier coordinator
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(addr)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.path = addr if family == socket.AF_UNIX else None
+        self.setup = dict(setup, type='setup', binary=base64.b64encode(zlib.compress(setup['binary'])).decode())
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.workers = {}   # socket -> Connection
+        self.number = 0     # id of the next task
+        print("Waiting for workers on %s\n" %address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for conn in list(self.workers.values()):
+            try:
+                send(conn.sock, {'type': 'done'})
+            except OSError:
+                pass
+            self.drop(conn, None)
+        self.selector.close()
+        self.listener.close()
+        if self.path is not None:
+            os.remove(self.path)
+
+    def drop(self, conn, requeue):
+        # the tasks of a worker that left are run by the others
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        del self.workers[conn.sock]
+        if requeue is not None and conn.pending:
+            print("A worker left, %d of its runs are sent to the others" %len(conn.pending))
+            requeue.extendleft(conn.pending.items())
+
+    def imap_unordered(self, func, tasks, chunksize=1):
+        """Yields the results of the tasks in the order they finish, as Pool.imap_unordered.
+
+        func is ignored: the workers run the execution mode of the setup.
+        """
+        tasks = iter(tasks)
+        for conn in self.workers.values():
+            conn.pending.clear()    # tasks of an interrupted earlier call, their results are ignored
+            conn.deadlines.clear()
+        requeue = deque()   # (id, task) of the workers that left
+        exhausted = False
+        waiting = False
+        checked = time.monotonic()  # last check of the deadlines
+        while True:
+            for conn in list(self.workers.values()):
+                while conn.jobs and len(conn.pending) < conn.jobs * chunksize * CREDIT:
+                    chunk = []
+                    while len(chunk) < chunksize and requeue:
+                        chunk.append(requeue.popleft())
+                    while len(chunk) < chunksize and not exhausted:
+                        task = next(tasks, None)
+                        if task is None:
+                            exhausted = True
+                        else:
+                            chunk.append((self.number, task))
+                            self.number += 1
+                    if not chunk:
+                        break
+                    now = time.monotonic()
+                    for number, task in chunk:
+                        # the tasks queued on the worker before this one run jobs at a time
+                        rounds = len(conn.pending) // conn.jobs + 1
+                        conn.deadlines[number] = now + rounds * (task[3] + RUN_OVERHEAD) + HANG_GRACE
+                        conn.pending[number] = task
+                    try:
+                        send(conn.sock, {'type': 'tasks', 'tasks': [encode_task(n, task) for n, task in chunk]})
+                    except OSError:
+                        self.drop(conn, requeue)
+                        break
+            if exhausted and not requeue and not any(conn.pending for conn in self.workers.values()):
+                return
+            if not self.workers and not waiting:
+                print("No worker connected, waiting for one...")
+            waiting = not self.workers
+            pending = any(conn.pending for conn in self.workers.values())
+            for key, mask in self.selector.select(1 if pending else None):
+                if key.fileobj is self.listener:
+                    sock, peer = self.listener.accept()
+                    sock.setblocking(True)
+                    self.workers[sock] = Connection(sock)
+                    self.selector.register(sock, selectors.EVENT_READ)
+                    continue
+                conn = self.workers.get(key.fileobj)
+                if conn is None:
+                    continue    # dropped while sending
+                try:
+                    messages = conn.messages()
+                except (OSError, ValueError):
+                    self.drop(conn, requeue)
+                    continue
+                for message in messages:
+                    if not valid(message):
+                        print("Ignoring an invalid message from a worker: %.200r" %(message,))
+                        continue
+                    if message['type'] == 'hello':
+                        conn.jobs = message['jobs']
+                        try:
+                            send(conn.sock, self.setup)
+                        except OSError:
+                            self.drop(conn, requeue)
+                            break
+                        print("A worker joined with %d jobs, %d workers" %(conn.jobs, len(self.workers)))
+                    elif message['id'] not in conn.pending:
+                        continue    # result of an interrupted earlier call
+                    elif message['type'] == 'error':
+                        # as with a pool, a failed task stops the campaign
+                        raise RuntimeError("A task failed on a worker:\n%s" %message['message'])
+                    else:
+                        try:
+                            res = decode_result(message['result'])
+                        except (KeyError, TypeError, ValueError):
+                            print("Invalid result from a worker, its runs are sent to the others: %.200r"
+                                  %(message,))
+                            self.drop(conn, requeue)
+                            break
+                        del conn.pending[message['id']]
+                        del conn.deadlines[message['id']]
+                        yield res
+            if time.monotonic() - checked >= 1:
+                # a hung worker would stall the campaign, its tasks are run by the others
+                checked = time.monotonic()
+                for conn in list(self.workers.values()):
+                    if any(deadline < checked for deadline in conn.deadlines.values()):
+                        print("A worker did not return a run in time, it is dropped")
+                        self.drop(conn, requeue)
+
+
+execute = None  # execution function of the pool processes of a worker, set once by init_process
+
+
+def init_process(function):
+    global execute
+    execute = function
+
+
+def execute_numbered(task):
+    from chaosduck import execute_task
+    number, task = task
+    try:
+        return number, execute_task(execute, task), None
+    except Exception:
+        return number, None, traceback.format_exc()
+
+
+def worker_execute(setup, workdir):
+    # the execution function of the campaign, run on the original binary of the worker
+    import chaosduck
+    infile = os.path.join(workdir, os.path.basename(setup['name']))
+    original = zlib.decompress(base64.b64decode(setup['binary']))
+    with open(infile, 'wb') as file:
+        file.write(original)
+    os.chmod(infile, 0o755)
+    arch = setup['arch']
+    if setup['exec_mode'] == 'forkserver':
+        return partial(chaosduck.execute_forked, infile, arch, setup['fork_at'], setup['limits'])
+    if setup['exec_mode'] == 'emulate':
+        fnargs = chaosduck.parse_args_spec(setup['function_args'])
+        return partial(chaosduck.execute_emulated, infile, setup['function'], fnargs, setup['max_instructions'])
+    return partial(chaosduck.execute_patched, original, arch, workdir, setup['limits'])
+
+
+def connect(address, retry):
+    family, addr = parse_address(address)
+    deadline = time.monotonic() + retry
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(addr)
+            return sock
+        except OSError:
+            sock.close()
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(1)
+
+
+def serve(sock, jobs):
+    # the tasks are run as they arrive and their results sent as they finish
+    reader = sock.makefile('rb')
+    lock = threading.Lock()
+    def sent(result):
+        number, res, error = result
+        if error is None:
+            message = {'type': 'result', 'id': number, 'result': encode_result(res)}
+        else:
+            message = {'type': 'error', 'id': number, 'message': error}
+        with lock:
+            try:
+                send(sock, message)
+            except OSError:
+                pass    # the coordinator left, the reader stops
+    send(sock, {'type': 'hello', 'jobs': jobs})
+    with tempfile.TemporaryDirectory(prefix='chaosduck-worker-') as workdir:
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("closed by the coordinator")
+        # the execution function, with the original binary, is sent once to each process
+        with Pool(processes=jobs, initializer=init_process,
+                  initargs=(worker_execute(json.loads(line), workdir),)) as pool:
+            for line in reader:
+                message = json.loads(line)
+                if message['type'] == 'done':
+                    return
+                for task in message['tasks']:
+                    pool.apply_async(execute_numbered, (decode_task(task),), callback=sent)
+    raise ConnectionError("closed by the coordinator")
+
+
+def run_worker(address, jobs, retry=60, persist=False):
+    """Run the tasks of the coordinator at address with jobs processes, until its campaign is done."""
+    while True:
+        sock = connect(address, retry)
+        print("Connected to", address)
+        try:
+            serve(sock, jobs)
+            print("Campaign done")
+        except (OSError, ValueError) as e:
+            print("Connection to the coordinator lost: %s" %e)
+        finally:
+            sock.close()
+        if not persist:
+            return
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Worker running the faulty binaries of a distributed campaign')
+    parser.add_argument('address', type=str, help='address of the coordinator: HOST:PORT or unix:PATH')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of runs at a time (default: number of CPUs)')
+    parser.add_argument('--retry', type=float, default=60,
+                        help='seconds to wait for the coordinator to listen (default: 60)')
+    parser.add_argument('--persist', action='store_true',
+                        help='wait for the next campaign instead of exiting after one')
+    args = parser.parse_args(argv[1:])
+    if args.jobs <= 0:
+        parser.error("jobs must be positive")
+    # a terminated worker still removes its copy of the binary
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    try:
+        parse_address(args.address)
+        run_worker(args.address, args.jobs, args.retry, args.persist)
+    except ValueError as e:
+        parser.error(str(e))
+    except OSError as e:
+        sys.exit("Connection to the coordinator failed: %s" %e)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,65 @@
+from elftools.elf.elffile import ELFFile
+from elftools.elf.constants import SH_FLAGS
+
+
+def binary_arch(infile):
+    """Architecture of a binary, as given on the command line of chaosduck ('arm' or 'x86')."""
+    with open(infile, 'rb') as file:
+        return 'arm' if ELFFile(file)['e_machine'] == 'EM_ARM' else 'x86'
+
+
+def code_address(elffile, arch, addr):
+    """Address of a virtual address in the disassembly of chaosduck, which uses file offsets on ARM.
+
+    :param elffile: the ELFFile of the binary
+    :param arch: 'x86' or 'arm'
+    :param addr: the virtual address
+    :return: the address in the disassembly
+    """
+    if arch == 'arm':
+        for section in elffile.iter_sections():
+            if section['sh_flags'] & SH_FLAGS.SHF_ALLOC and \
+                    section['sh_addr'] <= addr < section['sh_addr'] + section['sh_size']:
+                return addr - (section['sh_addr'] - section['sh_offset'])
+    return addr
+
+
+def function_range(infile, function, arch=None):
+    """Find the addresses of a function in the symbol table, or else in the DWARF debug information.
+
+    :param infile: path of the binary
+    :param function: name of the function
+    :param arch: None for virtual addresses, or 'x86' or 'arm' for the addresses of the disassembly
+    :return: the [start, end) addresses of the function
+    :raise ValueError: if the function is not found
+    """
+    with open(infile, 'rb') as file:
+        elffile = ELFFile(file)
+        start = None
+        symtab = elffile.get_section_by_name('.symtab')
+        symbols = symtab.get_symbol_by_name(function) if symtab is not None else None
+        if symbols:
+            start, end = symbols[0]['st_value'], symbols[0]['st_value'] + max(symbols[0]['st_size'], 1)
+        elif elffile.has_dwarf_info():
+            for cu in elffile.get_dwarf_info().iter_CUs():
+                for die in cu.iter_DIEs():
+                    attributes = die.attributes
+                    if die.tag != 'DW_TAG_subprogram' or 'DW_AT_low_pc' not in attributes or \
+                            'DW_AT_name' not in attributes or attributes['DW_AT_name'].value != function.encode():
+                        continue
+                    start = attributes['DW_AT_low_pc'].value
+                    high = attributes.get('DW_AT_high_pc')
+                    # since DWARF 4 the high pc is usually the size of the function
+                    if high is None:
+                        end = start + 1
+                    else:
+                        end = high.value if high.form == 'DW_FORM_addr' else start + high.value
+                    break
+                if start is not None:
+                    break
+        if start is None:
+            raise ValueError("Symbol not found in %s : %s" % (infile, function))
+        if arch is None:
+            return start, end
+        shift = start - code_address(elffile, arch, start)
+        return start - shift, end - shift
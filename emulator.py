@@ -0,0 +1,291 @@
+import signal, string, struct
+from elftools.elf.elffile import ELFFile
+from elftools.elf.relocation import RelocationSection
+from forkserver import load_layout, runtime_address
+
+try:
+    import unicorn
+    from unicorn import x86_const, arm_const
+except ImportError:  # optional dependency, only needed by the emulate execution mode
+    unicorn = None
+
+PAGE = 0x1000
+PIE_BASE = 0x400000     # position independent binaries are loaded there
+STACK = 0x7ff00000      # the stack of the emulated function
+STACK_SIZE = 0x10000
+BUFFERS = 0x7fe00000    # arguments passed by pointer (key, plaintext, outputs)
+BUFFERS_SIZE = 0x10000
+STOP = 0x7fd00000       # return address of the emulated function
+TLS = 0x7fc00000        # thread local storage (stack protector canary)
+RELATIVE = {'EM_386': 8, 'EM_X86_64': 8, 'EM_ARM': 23}  # R_*_RELATIVE relocation types
+
+
+def hex_to_bytes(text):
+    """Convert a hex string to bytes the way the sample binaries read it (sscanf %2hhx for each byte).
+
+    :param text: the hex string
+    :return: the bytes, a pair of characters without leading hex digit gives 0
+    """
+    data = []
+    for i in range(0, len(text), 2):
+        digits = ''
+        for c in text[i:i + 2]:
+            if c not in string.hexdigits:
+                break
+            digits += c
+        data.append(int(digits, 16) if digits else 0)
+    return bytes(data)
+
+
+def parse_args_spec(spec):
+    """Parse the description of the arguments of the emulated function.
+
+    :param spec: comma separated list of key, plaintext or out:SIZE (an output buffer of SIZE bytes)
+    :return: a list of (kind, size) tuples
+    """
+    fnargs = []
+    for arg in spec.split(','):
+        if arg in ('key', 'plaintext'):
+            fnargs.append((arg, None))
+        elif arg.startswith('out:') and arg[4:].isdigit() and int(arg[4:]) > 0:
+            fnargs.append(('out', int(arg[4:])))
+        else:
+            raise ValueError("Wrong function argument : " + arg)
+    return fnargs
+
+
+def descriptor(base, limit, access, flags):
+    """Encode an x86 segment descriptor."""
+    return ((limit & 0xffff) | (base & 0xffffff) << 16 | access << 40 | (limit >> 16) << 48 | flags << 52 |
+            (base >> 24) << 56)
+
+
+class Emulator:
+    """Runs a single function of a binary in an emulated CPU (unicorn) and applies the faults in memory.
+
+    The loadable segments of the binary are mapped once and the function is called with the key,
+    the plaintext and output buffers as pointer arguments. Each run restores the pages written by
+    the previous one, writes the patches to the emulated code and drops the stale translations, so
+    no faulty binary is ever written. An instruction limit replaces the wall clock timeout. The
+    function must not call shared libraries or perform syscalls, such runs end as a crash.
+    """
+
+    def __init__(self, infile, function, fnargs, max_instructions=1000000):
+        """Load the binary in the emulator.
+
+        :param infile: path of the binary (x86 32/64 bits or ARM)
+        :param function: symbol name or virtual address (number) of the emulated function
+        :param fnargs: arguments of the function as returned by parse_args_spec
+        :param max_instructions: number of instructions after which a run is considered as hanging
+        """
+        if unicorn is None:
+            raise RuntimeError("The emulate execution mode requires the unicorn package (pip install unicorn)")
+        bits, pie, self.segments, entry = load_layout(infile, function)
+        self.fnargs = fnargs
+        self.max_instructions = max_instructions
+        self.base = PIE_BASE if pie else 0
+        self.entry = self.base + entry
+        with open(infile, 'rb') as f:
+            elffile = ELFFile(f)
+            machine = elffile['e_machine']
+            if machine == 'EM_386' or machine == 'EM_X86_64':
+                self.uc = unicorn.Uc(unicorn.UC_ARCH_X86, unicorn.UC_MODE_32 if bits == 32 else unicorn.UC_MODE_64)
+                self.pc = x86_const.UC_X86_REG_EIP if bits == 32 else x86_const.UC_X86_REG_RIP
+            elif machine == 'EM_ARM':
+                self.uc = unicorn.Uc(unicorn.UC_ARCH_ARM, unicorn.UC_MODE_ARM)
+                self.pc = arm_const.UC_ARM_REG_PC
+            else:
+                raise RuntimeError("Unsupported architecture : " + machine)
+            self.machine = machine
+            self.bits = bits
+            self.load(elffile)
+        self.uc.hook_add(unicorn.UC_HOOK_INTR, self.interrupt)
+
+    def load(self, elffile):
+        """Map the loadable segments, apply the relative relocations and protect the writable memory."""
+        uc = self.uc
+        pages = {}
+        for segment in elffile.iter_segments():
+            if segment['p_type'] != 'PT_LOAD':
+                continue
+            prot = ((unicorn.UC_PROT_READ if segment['p_flags'] & 4 else 0) |
+                    (unicorn.UC_PROT_WRITE if segment['p_flags'] & 2 else 0) |
+                    (unicorn.UC_PROT_EXEC if segment['p_flags'] & 1 else 0))
+            start = (self.base + segment['p_vaddr']) & ~(PAGE - 1)
+            end = self.base + segment['p_vaddr'] + segment['p_memsz']
+            for page in range(start, end, PAGE):
+                pages[page] = pages.get(page, 0) | prot
+        # map the runs of contiguous pages with the same protection at once
+        runs = []
+        for page in sorted(pages):
+            if runs and runs[-1][1] == page and runs[-1][2] == pages[page]:
+                runs[-1][1] = page + PAGE
+            else:
+                runs.append([page, page + PAGE, pages[page]])
+        for start, end, prot in runs:
+            uc.mem_map(start, end - start, prot)
+        for segment in elffile.iter_segments():
+            if segment['p_type'] == 'PT_LOAD':
+                uc.mem_write(self.base + segment['p_vaddr'], segment.data())
+        word = 'I' if self.bits == 32 else 'Q'
+        for section in elffile.iter_sections():
+            if not isinstance(section, RelocationSection):
+                continue
+            for reloc in section.iter_relocations():
+                if reloc['r_info_type'] != RELATIVE.get(self.machine):
+                    continue
+                addr = self.base + reloc['r_offset']
+                if reloc.is_RELA():
+                    value = self.base + reloc['r_addend']
+                else:
+                    value = struct.unpack('<' + word, self.uc.mem_read(addr, self.bits // 8))[0] + self.base
+                uc.mem_write(addr, struct.pack('<' + word, value & (2 ** self.bits - 1)))
+        writable = [page for page in sorted(pages) if pages[page] & unicorn.UC_PROT_WRITE]
+        uc.mem_map(STACK, STACK_SIZE, unicorn.UC_PROT_READ | unicorn.UC_PROT_WRITE)
+        uc.mem_map(BUFFERS, BUFFERS_SIZE, unicorn.UC_PROT_READ | unicorn.UC_PROT_WRITE)
+        uc.mem_map(STOP, PAGE, unicorn.UC_PROT_ALL)
+        # x86 binaries read the stack protector canary through fs (64 bits) or gs (32 bits)
+        uc.mem_map(TLS, PAGE, unicorn.UC_PROT_READ | unicorn.UC_PROT_WRITE)
+        if self.machine == 'EM_X86_64':
+            uc.reg_write(x86_const.UC_X86_REG_FS_BASE, TLS)
+        elif self.machine == 'EM_386':
+            # gs needs a segment descriptor in 32-bit mode, which needs a descriptor table with flat
+            # code and data segments as well
+            gdt = [0, descriptor(0, 0xfffff, 0x9a, 0xc), descriptor(0, 0xfffff, 0x92, 0xc),
+                   descriptor(TLS, PAGE - 1, 0x92, 0x4)]
+            uc.mem_write(TLS + PAGE // 2, struct.pack('<%dQ' % len(gdt), *gdt))
+            uc.reg_write(x86_const.UC_X86_REG_GDTR, (0, TLS + PAGE // 2, len(gdt) * 8 - 1, 0))
+            uc.reg_write(x86_const.UC_X86_REG_CS, 1 << 3)
+            for reg in (x86_const.UC_X86_REG_SS, x86_const.UC_X86_REG_DS, x86_const.UC_X86_REG_ES):
+                uc.reg_write(reg, 2 << 3)
+            uc.reg_write(x86_const.UC_X86_REG_GS, 3 << 3)
+        # every run starts from the same memory and registers whatever the previous runs did: the writable
+        # pages are write protected, the first write of a run to one of them lifts the protection (track),
+        # the next run restores the pages without protection and only protects again the ones that the
+        # arguments of the call do not overwrite anyway
+        self.pristine = {}
+        for page in writable + [TLS]:
+            prot = pages.get(page, unicorn.UC_PROT_READ | unicorn.UC_PROT_WRITE)
+            self.pristine[page] = (bytes(uc.mem_read(page, PAGE)), prot)
+        for page in [*range(STACK, STACK + STACK_SIZE, PAGE), *range(BUFFERS, BUFFERS + BUFFERS_SIZE, PAGE)]:
+            self.pristine[page] = (bytes(PAGE), unicorn.UC_PROT_READ | unicorn.UC_PROT_WRITE)
+        for page, (data, prot) in self.pristine.items():
+            uc.mem_protect(page, PAGE, prot & ~unicorn.UC_PROT_WRITE)
+        self.dirty = set()      # the pages without write protection
+        self.arguments = set()  # the pages written by the last call
+        uc.hook_add(unicorn.UC_HOOK_MEM_WRITE_PROT, self.track)
+        self.context = uc.context_save()
+
+    def track(self, uc, access, address, size, value, user_data):
+        # first write of the run to a write protected page, the writes to the code or read-only data crash
+        pages = range(address & ~(PAGE - 1), address + size, PAGE)
+        if any(page not in self.pristine for page in pages):
+            return False
+        for page in pages:
+            self.touch(page)
+        # unicorn does not retry the write that raised the event
+        uc.mem_write(address, (value & (2 ** (8 * size) - 1)).to_bytes(size, 'little'))
+        return True
+
+    def touch(self, page):
+        """Give the write access back to a writable page, it is restored before the next run."""
+        if page not in self.dirty:
+            self.uc.mem_protect(page, PAGE, self.pristine[page][1])
+            self.dirty.add(page)
+
+    def write(self, addr, data):
+        """Write the arguments of the call to the emulated memory."""
+        for page in range(addr & ~(PAGE - 1), addr + len(data), PAGE):
+            self.touch(page)
+            self.arguments.add(page)
+        self.uc.mem_write(addr, data)
+
+    def reset(self):
+        """Restore the pages written since the last reset."""
+        for page in self.dirty:
+            self.uc.mem_write(page, self.pristine[page][0])
+        for page in self.dirty - self.arguments:
+            self.uc.mem_protect(page, PAGE, self.pristine[page][1] & ~unicorn.UC_PROT_WRITE)
+        self.dirty &= self.arguments
+        self.arguments = set()
+
+    def interrupt(self, uc, intno, user_data):
+        # syscalls (int 0x80, syscall, svc) cannot be served in a single function
+        self.syscall = True
+        uc.emu_stop()
+
+    def call(self, key, plaintext):
+        """Write the arguments and set the registers to call the function, returns the output buffers."""
+        uc = self.uc
+        pointers = []
+        outputs = []
+        addr = BUFFERS
+        for kind, size in self.fnargs:
+            data = hex_to_bytes(key) if kind == 'key' else hex_to_bytes(plaintext) if kind == 'plaintext' \
+                else bytes(size)
+            self.write(addr, data)
+            pointers.append(addr)
+            if kind == 'out':
+                outputs.append((addr, size))
+            addr += (len(data) + 15) & ~15
+        sp = STACK + STACK_SIZE - 0x100
+        if self.machine == 'EM_386':    # cdecl, arguments on the stack after the return address
+            self.write(sp, struct.pack('<%dI' % (len(pointers) + 1), STOP, *pointers))
+            uc.reg_write(x86_const.UC_X86_REG_ESP, sp)
+        elif self.machine == 'EM_X86_64':   # System V, arguments in registers
+            for reg, pointer in zip((x86_const.UC_X86_REG_RDI, x86_const.UC_X86_REG_RSI, x86_const.UC_X86_REG_RDX,
+                                     x86_const.UC_X86_REG_RCX, x86_const.UC_X86_REG_R8, x86_const.UC_X86_REG_R9),
+                                    pointers):
+                uc.reg_write(reg, pointer)
+            self.write(sp - 8, struct.pack('<Q', STOP))
+            uc.reg_write(x86_const.UC_X86_REG_RSP, sp - 8)
+        else:   # AAPCS, arguments in r0-r3 and return address in lr
+            for reg, pointer in zip((arm_const.UC_ARM_REG_R0, arm_const.UC_ARM_REG_R1, arm_const.UC_ARM_REG_R2,
+                                     arm_const.UC_ARM_REG_R3), pointers):
+                uc.reg_write(reg, pointer)
+            uc.reg_write(arm_const.UC_ARM_REG_LR, STOP)
+            uc.reg_write(arm_const.UC_ARM_REG_SP, sp)
+        return outputs
+
+    def run(self, patches, key, plaintext):
+        """Run the function with the patches applied to the emulated memory.
+
+        :param patches: list of (file offset, bytes) pairs as returned by FaultModel.patches
+        :param key: the key as a hex string
+        :param plaintext: the plaintext as a hex string
+        :return: a dict with the stdout (the output buffers printed as the sample binaries do), stderr,
+                 exitcode and timedout fields of the run
+        """
+        uc = self.uc
+        self.reset()
+        uc.context_restore(self.context)
+        outputs = self.call(key, plaintext)
+        saved = []
+        for offset, value in patches:
+            addr = runtime_address(self.segments, self.base, offset)
+            if addr is not None:    # bytes that are not loaded cannot change the run
+                saved.append((addr, bytes(uc.mem_read(addr, len(value)))))
+                uc.mem_write(addr, value)
+                uc.ctl_remove_cache(addr, addr + len(value))
+        self.syscall = False
+        exitcode = 0
+        timedout = False
+        errs = b''
+        try:
+            uc.emu_start(self.entry, STOP, count=self.max_instructions)
+            if self.syscall:
+                exitcode = -signal.SIGSYS
+                errs = b'syscall in the emulated function\n'
+            elif uc.reg_read(self.pc) != STOP:
+                exitcode = -signal.SIGKILL
+                timedout = True
+        except unicorn.UcError as e:
+            exitcode = -signal.SIGILL if e.errno == unicorn.UC_ERR_INSN_INVALID else -signal.SIGSEGV
+            errs = str(e).encode() + b'\n'
+        for addr, value in saved:
+            uc.mem_write(addr, value)
+            uc.ctl_remove_cache(addr, addr + len(value))
+        outs = b''
+        if exitcode == 0:
+            outs = b''.join(b'0x%02x ' % b for addr, size in outputs for b in uc.mem_read(addr, size)) + b'\n'
+        return {'stdout': outs, 'stderr': errs, 'exitcode': exitcode, 'timedout': timedout}
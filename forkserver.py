@@ -0,0 +1,380 @@
+import os, time, signal, ctypes, platform, resource
+from functools import partial
+from subprocess import Popen, DEVNULL
+from elftools.elf.elffile import ELFFile
+
+# ptrace requests and options (see ptrace(2))
+PTRACE_TRACEME = 0
+PTRACE_PEEKUSER = 3
+PTRACE_CONT = 7
+PTRACE_SINGLESTEP = 9
+PTRACE_GETREGS = 12
+PTRACE_SETREGS = 13
+PTRACE_DETACH = 17
+PTRACE_SETOPTIONS = 0x4200
+PTRACE_GETEVENTMSG = 0x4201
+PTRACE_O_TRACEFORK = 0x02
+PTRACE_O_EXITKILL = 0x100000
+PTRACE_EVENT_FORK = 1
+WALL = 0x40000000
+CLONE_PARENT = 0x8000
+PR_SET_PDEATHSIG = 1
+
+# resource limits of a run by name (see setrlimit(2)), the limits of a run
+# also have the size of the output kept ('output')
+RLIMITS = {'cpu': resource.RLIMIT_CPU, 'as': resource.RLIMIT_AS, 'fsize': resource.RLIMIT_FSIZE,
+           'nproc': resource.RLIMIT_NPROC}
+
+libc = ctypes.CDLL(None, use_errno=True)
+libc.ptrace.argtypes = [ctypes.c_long, ctypes.c_long, ctypes.c_void_p, ctypes.c_void_p]
+libc.ptrace.restype = ctypes.c_long
+
+
+class UserRegs(ctypes.Structure):
+    """struct user_regs_struct of an x86_64 tracer (also used for 32-bit tracees)."""
+    _fields_ = [(name, ctypes.c_ulonglong) for name in (
+        'r15', 'r14', 'r13', 'r12', 'rbp', 'rbx', 'r11', 'r10', 'r9', 'r8', 'rax', 'rcx', 'rdx', 'rsi', 'rdi',
+        'orig_rax', 'rip', 'cs', 'eflags', 'rsp', 'ss', 'fs_base', 'gs_base', 'ds', 'es', 'fs', 'gs')]
+
+
+def ptrace(request, pid, addr=0, data=0):
+    res = libc.ptrace(request, pid, addr, data)
+    if res == -1 and ctypes.get_errno() != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return res
+
+
+def load_layout(infile, fork_at):
+    """Read the layout of an ELF binary.
+
+    :param infile: path of the binary
+    :param fork_at: symbol name or virtual address (number) of the fork point
+    :return: the ELF class (32 or 64), whether it is position independent, its loadable segments
+             as (offset, size, virtual address) tuples and the virtual address of the fork point
+    """
+    with open(infile, 'rb') as f:
+        elffile = ELFFile(f)
+        segments = [(s['p_offset'], s['p_filesz'], s['p_vaddr']) for s in elffile.iter_segments()
+                    if s['p_type'] == 'PT_LOAD']
+        try:
+            entry = int(fork_at, 0)
+        except ValueError:
+            symtab = elffile.get_section_by_name('.symtab')
+            symbols = symtab.get_symbol_by_name(fork_at) if symtab is not None else None
+            if not symbols:
+                raise ValueError("Symbol not found in %s : %s" % (infile, fork_at))
+            entry = symbols[0]['st_value']
+        return elffile.elfclass, elffile['e_type'] == 'ET_DYN', segments, entry
+
+
+def runtime_address(segments, base, offset):
+    """Returns the runtime address of a file offset, or None if it is not loaded in memory."""
+    for p_offset, p_filesz, p_vaddr in segments:
+        if p_offset <= offset < p_offset + p_filesz:
+            return base + p_vaddr + offset - p_offset
+    return None
+
+
+def load_base(pid, infile, segments):
+    """Returns the address a (PIE) binary was loaded at in a process."""
+    with open('/proc/%d/maps' % pid) as maps:
+        for line in maps:
+            fields = line.split()
+            if len(fields) >= 6 and fields[5] == infile and int(fields[2], 16) == 0:
+                return int(fields[0].split('-')[0], 16) - (min(s[2] for s in segments) & ~0xfff)
+    raise RuntimeError("%s is not mapped in process %d" % (infile, pid))
+
+
+def set_limits(limits, pid=0, output_files=False):
+    """Apply the resource limits of a run to a process.
+
+    :param limits: dict of the limits by name (RLIMITS and 'output'), None for no limit
+    :param pid: the process, 0 for the calling one (preexec_fn of a Popen)
+    :param output_files: the output is written to files, the output size is also a file size limit
+    """
+    limits = dict(limits)
+    if output_files and limits.get('output') is not None:
+        if pid == 0 and output_over_limit_dropped(limits):
+            ignore_fsize_signal()
+        # one byte more than the output kept, to tell a longer output from one of exactly the limit
+        limits['fsize'] = min(limits['output'] + 1, limits.get('fsize') or limits['output'] + 1)
+    for name, value in limits.items():
+        if name not in RLIMITS or value is None:
+            continue
+        _, hard = resource.prlimit(pid, RLIMITS[name])
+        # SIGXCPU is sent at the soft CPU limit, SIGKILL only at the hard one
+        new = value + 1 if name == 'cpu' else value
+        if hard != resource.RLIM_INFINITY:
+            new = min(new, hard)
+        resource.prlimit(pid, RLIMITS[name], (min(value, new), new))
+
+
+def read_outputs(stdout, stderr, limit=None):
+    """Returns the stdout and stderr written to memory files, cut to the limit, and whether one was longer."""
+    outputs = []
+    truncated = False
+    for fd in (stdout, stderr):
+        size = os.fstat(fd).st_size
+        if limit is not None and size > limit:
+            truncated = True
+            size = limit
+        outputs.append(os.pread(fd, size, 0))
+    return outputs[0], outputs[1], truncated
+
+
+def output_over_limit_dropped(limits):
+    """Whether the output size is the file size limit of a run writing its output to files."""
+    return limits.get('output') is not None and (limits.get('fsize') is None or limits['fsize'] > limits['output'])
+
+
+def ignore_fsize_signal():
+    # a write over the file size limit fails with EFBIG instead of killing the
+    # process: like in the other execution modes, where the output over the
+    # limit is dropped, the run goes on and is only marked as truncated
+    signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+
+
+def traceme(ignore_fsize=False):
+    # runs in the forked child right before exec, the tracee then stops on exec
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGCHLD})
+    # the children of the server are reaped by the kernel and do not signal it
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    # the forks of the server inherit it
+    if ignore_fsize:
+        ignore_fsize_signal()
+    libc.ptrace(PTRACE_TRACEME, 0, None, None)
+
+
+class ForkServer:
+    """Keeps the original binary stopped at a fork point and runs every fault in a patched fork of it.
+
+    The binary is started once with the given arguments and stopped at the fork point (e.g. main).
+    For each fault a fork (clone) syscall is injected in it, the patches are written to the text of
+    the child through /proc/<pid>/mem and the child is detached, so a run costs a fork instead of an
+    exec, a dynamic link and the libc startup. Faults in code executed before the fork point
+    (the loader, _start, .init) are therefore not observed.
+    """
+
+    def __init__(self, infile, args, fork_at='main', limits=None):
+        """Start the binary and stop it at the fork point.
+
+        :param infile: path of the original (native x86) binary
+        :param args: command line arguments of the binary
+        :param fork_at: symbol name or virtual address (number) where the binary is stopped
+        :param limits: resource limits of every run (see set_limits), the output over the limit is dropped
+        """
+        self.limits = limits or {}
+        if platform.machine() != 'x86_64':
+            raise RuntimeError("The fork server requires an x86_64 host")
+        self.infile = os.path.realpath(infile)
+        self.bits, self.pie, self.segments, self.entry = load_layout(self.infile, fork_at)
+        # syscalls through "int 0x80" on i386 and through "syscall" on x86_64: the numbers of clone and
+        # prctl, and the registers of the arguments
+        if self.bits == 32:
+            self.syscall_code, self.clone_nr, self.prctl_nr = b'\xcd\x80', 120, 172
+            self.syscall_args = ('rbx', 'rcx', 'rdx', 'rsi', 'rdi')
+        else:
+            self.syscall_code, self.clone_nr, self.prctl_nr = b'\x0f\x05', 56, 157
+            self.syscall_args = ('rdi', 'rsi', 'rdx', 'r10', 'r8')
+        # the children write their output in memory files shared with the server
+        self.stdout = os.memfd_create('stdout', os.MFD_CLOEXEC)
+        self.stderr = os.memfd_create('stderr', os.MFD_CLOEXEC)
+        # tracee stops are reported with SIGCHLD, wait for it instead of polling
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGCHLD})
+        self.process = Popen([self.infile] + list(args), stdin=DEVNULL, stdout=self.stdout, stderr=self.stderr,
+                             preexec_fn=partial(traceme, output_over_limit_dropped(self.limits)))
+        self.pid = self.process.pid
+        self.wait(self.pid)  # stopped on exec
+        ptrace(PTRACE_SETOPTIONS, self.pid, 0, PTRACE_O_TRACEFORK | PTRACE_O_EXITKILL)
+        self.base = load_base(self.pid, self.infile, self.segments) if self.pie else 0
+        self.entry += self.base
+        # run up to the fork point with a breakpoint (int3)
+        saved = self.read(self.pid, self.entry, 1)
+        self.write(self.pid, self.entry, b'\xcc')
+        ptrace(PTRACE_CONT, self.pid)
+        status = self.wait(self.pid)
+        if not os.WIFSTOPPED(status) or os.WSTOPSIG(status) != signal.SIGTRAP:
+            self.close()
+            raise RuntimeError("%s did not reach the fork point" % infile)
+        self.write(self.pid, self.entry, saved)
+        self.regs = self.get_regs(self.pid)
+        self.regs.rip = self.entry
+        self.set_regs(self.pid, self.regs)
+
+    def wait(self, pid, deadline=None):
+        """Wait for a stop or the end of a tracee, returns None if the deadline is reached first."""
+        while True:
+            wpid, status = os.waitpid(pid, os.WNOHANG | WALL)
+            if wpid == pid:
+                return status
+            if deadline is None:
+                signal.sigtimedwait({signal.SIGCHLD}, 3600)
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                signal.sigtimedwait({signal.SIGCHLD}, remaining)
+
+    def step(self, pid):
+        """Single-step a tracee, signals sent to it in the meantime are discarded."""
+        while True:
+            ptrace(PTRACE_SINGLESTEP, pid)
+            status = self.wait(pid)
+            if not os.WIFSTOPPED(status):
+                raise RuntimeError("The fork server died")
+            if os.WSTOPSIG(status) == signal.SIGTRAP:
+                return status
+
+    @staticmethod
+    def read(pid, addr, size):
+        with open('/proc/%d/mem' % pid, 'rb', buffering=0) as mem:
+            mem.seek(addr)
+            return mem.read(size)
+
+    @staticmethod
+    def write(pid, addr, data):
+        with open('/proc/%d/mem' % pid, 'r+b', buffering=0) as mem:
+            mem.seek(addr)
+            mem.write(data)
+
+    @staticmethod
+    def get_regs(pid):
+        regs = UserRegs()
+        ptrace(PTRACE_GETREGS, pid, 0, ctypes.addressof(regs))
+        return regs
+
+    @staticmethod
+    def set_regs(pid, regs):
+        ptrace(PTRACE_SETREGS, pid, 0, ctypes.addressof(regs))
+
+    def syscall(self, pid, nr, *args):
+        """Run a syscall in a tracee stopped with the syscall instruction at the fork point."""
+        regs = UserRegs.from_buffer_copy(self.regs)
+        regs.rax = nr
+        for name, value in zip(self.syscall_args, args):
+            setattr(regs, name, value)
+        self.set_regs(pid, regs)
+        return self.step(pid)
+
+    def fork(self):
+        """Inject a fork at the fork point and return the pid of the (stopped) child.
+
+        The child is created by clone() as a sibling of the server (CLONE_PARENT), so it is a child of
+        this process that can be waited for once it is no longer traced. It is killed with this process.
+        """
+        saved = self.read(self.pid, self.entry, len(self.syscall_code))
+        self.write(self.pid, self.entry, self.syscall_code)
+        status = self.syscall(self.pid, self.clone_nr, CLONE_PARENT | signal.SIGCHLD)
+        if status >> 8 != signal.SIGTRAP | (PTRACE_EVENT_FORK << 8):
+            raise RuntimeError("fork() injection failed in the fork server")
+        child = ctypes.c_ulong()
+        ptrace(PTRACE_GETEVENTMSG, self.pid, 0, ctypes.addressof(child))
+        self.step(self.pid)  # return from the syscall
+        self.write(self.pid, self.entry, saved)
+        self.set_regs(self.pid, self.regs)
+        # the child is a copy of the server after the syscall, rewind it to the fork point
+        child = child.value
+        self.wait(child)
+        ptrace(PTRACE_SETOPTIONS, child, 0, PTRACE_O_EXITKILL)
+        self.syscall(child, self.prctl_nr, PR_SET_PDEATHSIG, signal.SIGKILL)
+        self.write(child, self.entry, saved)
+        self.set_regs(child, self.regs)
+        return child
+
+    def run(self, patches, timeout=3):
+        """Run a fork of the binary with the patches applied to its memory.
+
+        :param patches: list of (file offset, bytes) pairs as returned by FaultModel.patches
+        :param timeout: time in seconds after which the child is killed
+        :return: a dict with the stdout, stderr, exitcode, timedout and truncated fields of the run
+        """
+        for fd in (self.stdout, self.stderr):
+            os.ftruncate(fd, 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+        child = self.fork()
+        set_limits(self.limits, child, output_files=True)
+        for offset, value in patches:
+            addr = runtime_address(self.segments, self.base, offset)
+            if addr is not None:   # bytes that are not loaded cannot change the run
+                self.write(child, addr, value)
+        timedout = False
+        deadline = time.monotonic() + timeout
+        # the child runs untraced, its signals are handled by the kernel as in the other execution modes
+        ptrace(PTRACE_DETACH, child)
+        status = self.wait(child, deadline)
+        if status is None:
+            timedout = True
+            os.kill(child, signal.SIGKILL)
+            status = self.wait(child)
+        exitcode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        outs, errs, truncated = read_outputs(self.stdout, self.stderr, self.limits.get('output'))
+        return {'stdout': outs, 'stderr': errs, 'exitcode': exitcode, 'timedout': timedout, 'truncated': truncated}
+
+    def close(self):
+        """Kill the fork server."""
+        self.process.kill()
+        self.process.wait()
+        os.close(self.stdout)
+        os.close(self.stderr)
+
+
+def trace_executed(infile, args, timeout=60):
+    """Single-step a run of a native x86 binary and return the instructions of the binary it executes.
+
+    The binary is run under ptrace from its entry point to its exit. The instructions of the loader
+    and of the shared libraries are stepped through but not recorded.
+
+    :param infile: path of the binary
+    :param args: command line arguments of the binary
+    :param timeout: time in seconds after which the run is killed
+    :return: the set of the (link-time) virtual addresses of the executed instructions of the binary
+    """
+    if platform.machine() != 'x86_64':
+        raise RuntimeError("Tracing requires an x86_64 host")
+    infile = os.path.realpath(infile)
+    with open(infile, 'rb') as f:
+        elffile = ELFFile(f)
+        pie = elffile['e_type'] == 'ET_DYN'
+        entry = elffile['e_entry']
+        segments = [(s['p_offset'], s['p_filesz'], s['p_vaddr']) for s in elffile.iter_segments()
+                    if s['p_type'] == 'PT_LOAD']
+    process = Popen([infile] + list(args), stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, preexec_fn=traceme)
+    pid = process.pid
+    try:
+        os.waitpid(pid, WALL)  # stopped on exec
+        ptrace(PTRACE_SETOPTIONS, pid, 0, PTRACE_O_EXITKILL)
+        base = load_base(pid, infile, segments) if pie else 0
+        start = base + min(s[2] for s in segments)
+        end = base + max(s[2] + s[1] for s in segments)
+        # run the loader up to the entry point with a breakpoint (int3)
+        saved = ForkServer.read(pid, base + entry, 1)
+        ForkServer.write(pid, base + entry, b'\xcc')
+        ptrace(PTRACE_CONT, pid)
+        _, status = os.waitpid(pid, WALL)
+        if not os.WIFSTOPPED(status) or os.WSTOPSIG(status) != signal.SIGTRAP:
+            raise RuntimeError("%s did not reach its entry point" % infile)
+        ForkServer.write(pid, base + entry, saved)
+        regs = ForkServer.get_regs(pid)
+        regs.rip = base + entry
+        ForkServer.set_regs(pid, regs)
+        executed = set()
+        deadline = time.monotonic() + timeout
+        rip_offset = UserRegs.rip.offset
+        sig = 0
+        steps = 0
+        while True:
+            rip = libc.ptrace(PTRACE_PEEKUSER, pid, rip_offset, None) & 0xFFFFFFFFFFFFFFFF
+            if start <= rip < end:
+                executed.add(rip - base)
+            ptrace(PTRACE_SINGLESTEP, pid, 0, sig)
+            _, status = os.waitpid(pid, WALL)
+            if not os.WIFSTOPPED(status):
+                return executed
+            sig = 0 if os.WSTOPSIG(status) == signal.SIGTRAP else os.WSTOPSIG(status)
+            steps += 1
+            if steps % 65536 == 0 and time.monotonic() > deadline:
+                raise RuntimeError("Tracing %s timed out" % infile)
+    finally:
+        process.kill()
+        process.wait()
@@ -0,0 +1,287 @@
+import os, re, glob, socket, signal, struct, time
+from subprocess import Popen, DEVNULL, PIPE, TimeoutExpired, run
+from elftools.elf.elffile import ELFFile
+from forkserver import load_layout, runtime_address, set_limits, read_outputs
+
+# ARM code written over _start once the binary is stopped at the fork point (_start is not used any more):
+# the fork server forks, the child reloads the registers saved below the stack pointer (pc = fork point)
+# and the parent waits for the child and stops on the last instruction
+TRAMPOLINE = struct.pack('<12I',
+                         0xE3A07002,  # mov r7, #2 (fork)
+                         0xEF000000,  # svc #0
+                         0xE3500000,  # cmp r0, #0
+                         0x1A000001,  # bne parent
+                         0xE24D0080,  # sub r0, sp, #128
+                         0xE890FFFF,  # ldm r0, {r0-r12, sp, lr, pc}
+                         0xE24D1084,  # parent: sub r1, sp, #132
+                         0xE3A02000,  # mov r2, #0
+                         0xE3A03000,  # mov r3, #0
+                         0xE3A07072,  # mov r7, #114 (wait4)
+                         0xEF000000,  # svc #0
+                         0xEAFFFFFE)  # done: b done
+QEMU_VERSION = (8, 1)   # oldest qemu-arm supported, its gdb stub writes to read-only guest pages
+REGS_OFFSET = 128   # the registers of the child are saved at sp - 128
+STATUS_OFFSET = 132  # wait4 writes the status of the child at sp - 132
+
+
+def qemu_version():
+    """Returns the version of qemu-arm as a (major, minor) tuple, None if it cannot be run or is unknown."""
+    try:
+        output = run(['qemu-arm', '--version'], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, timeout=10).stdout
+    except (OSError, TimeoutExpired):
+        return None
+    match = re.search(rb'version (\d+)\.(\d+)', output)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def check_qemu():
+    """Raise a RuntimeError unless qemu-arm is installed in a supported version (QEMU_VERSION or later)."""
+    version = qemu_version()
+    if version is None:
+        raise RuntimeError("qemu-arm is not installed or its version is unknown, %d.%d or later is required"
+                           % QEMU_VERSION)
+    if version < QEMU_VERSION:
+        raise RuntimeError("qemu-arm %d.%d is not supported, %d.%d or later is required" % (version + QEMU_VERSION))
+
+
+class GdbRemote:
+    """Minimal client of the GDB remote serial protocol."""
+
+    def __init__(self, port, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.sock = socket.create_connection(('127.0.0.1', port))
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        self.buffer = b''
+        self.ack = True
+        self.command('QStartNoAckMode')
+        self.ack = False
+
+    def send(self, data):
+        data = data.encode()
+        self.sock.sendall(b'$%s#%02x' % (data, sum(data) & 0xFF))
+
+    def receive(self, timeout=None):
+        """Returns the next packet, or None if none is received before the timeout."""
+        self.sock.settimeout(timeout)
+        while True:
+            start = self.buffer.find(b'$')
+            end = self.buffer.find(b'#', start)
+            if start != -1 and end != -1 and len(self.buffer) >= end + 3:
+                packet = self.buffer[start + 1:end].decode()
+                self.buffer = self.buffer[end + 3:]
+                if self.ack:
+                    self.sock.sendall(b'+')
+                return packet
+            try:
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                return None
+            if not chunk:
+                raise RuntimeError("qemu closed the gdb connection")
+            self.buffer += chunk
+
+    def command(self, data):
+        self.send(data)
+        return self.receive()
+
+    def check(self, data):
+        reply = self.command(data)
+        if reply != 'OK':
+            raise RuntimeError("gdb command %s failed : %s" % (data.split(':')[0], reply))
+
+    def read(self, addr, size):
+        return bytes.fromhex(self.command('m%x,%x' % (addr, size)))
+
+    def write(self, addr, data):
+        self.check('M%x,%x:%s' % (addr, len(data), data.hex()))
+
+    def set_reg(self, n, value):
+        self.check('P%x=%s' % (n, struct.pack('<I', value).hex()))
+
+    def regs(self):
+        return list(struct.unpack_from('<16I', bytes.fromhex(self.command('g'))))
+
+
+class QemuServer:
+    """Keeps one qemu-arm instance stopped at a fork point and runs every fault in a patched fork of it.
+
+    The binary is started once under qemu-arm with its gdb stub and stopped at the fork point (e.g. main).
+    For each fault the patches are written to the guest memory through the stub, which also drops the
+    stale translations, and a fork of the guest is run from the fork point while the emulator waits for
+    it, then the original bytes are restored. A run therefore costs a fork of the emulator instead of
+    its startup and the loading of the sysroot. Requires qemu 8.1 or later (debugger writes to read-only
+    guest pages), older or unknown versions are refused. Faults in code executed before the fork point
+    are not observed.
+    """
+
+    def __init__(self, infile, args, fork_at='main', sysroot='/usr/arm-linux-gnueabi/', limits=None):
+        """Start the binary under qemu-arm and stop it at the fork point.
+
+        :param infile: path of the original ARM binary
+        :param args: command line arguments of the binary
+        :param fork_at: symbol name or virtual address (number) where the binary is stopped
+        :param sysroot: ELF interpreter prefix passed to qemu-arm -L
+        :param limits: resource limits (see set_limits) of the emulator, inherited by the fork of every run
+        """
+        check_qemu()
+        self.limits = limits or {}
+        self.infile = os.path.realpath(infile)
+        _, pie, self.segments, entry = load_layout(self.infile, fork_at)
+        self.cave = self.find_cave()
+        # the children write their output in memory files shared with the emulator
+        self.stdout = os.memfd_create('stdout', os.MFD_CLOEXEC)
+        self.stderr = os.memfd_create('stderr', os.MFD_CLOEXEC)
+        with socket.socket() as s:  # pick a free port for the gdb stub
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        self.process = Popen(['qemu-arm', '-L', sysroot, '-g', str(port), self.infile] + list(args),
+                             stdin=DEVNULL, stdout=self.stdout, stderr=self.stderr,
+                             preexec_fn=lambda: set_limits(self.limits, output_files=True))
+        try:
+            self.gdb = GdbRemote(port)
+            offsets = dict(field.split('=') for field in self.gdb.command('qOffsets').split(';'))
+            self.base = int(offsets['Text'], 16) if pie else 0
+            entry += self.base
+            self.cave += self.base
+            self.gdb.check('Z0,%x,4' % entry)
+            self.stopped(self.gdb.command('c'))
+            self.gdb.check('z0,%x,4' % entry)
+            regs = self.gdb.regs()
+            self.sp = regs[13]
+            regs[15] = entry
+            self.gdb.write(self.sp - REGS_OFFSET, struct.pack('<16I', *regs))
+            self.gdb.write(self.cave, TRAMPOLINE)
+            self.gdb.check('Z0,%x,4' % (self.cave + len(TRAMPOLINE) - 4))
+        except Exception:
+            self.close()
+            raise
+
+    def find_cave(self):
+        """Returns the address of _start, which is overwritten with the trampoline."""
+        with open(self.infile, 'rb') as f:
+            symtab = ELFFile(f).get_section_by_name('.symtab')
+            if symtab is None:
+                raise RuntimeError("%s has no symbol table" % self.infile)
+            functions = sorted(s['st_value'] for s in symtab.iter_symbols() if s['st_info']['type'] == 'STT_FUNC')
+            start = symtab.get_symbol_by_name('_start')
+        if not start or start[0]['st_value'] + len(TRAMPOLINE) > min(v for v in functions + [2 ** 32]
+                                                                     if v > start[0]['st_value']):
+            raise RuntimeError("No room for the fork trampoline in _start of %s" % self.infile)
+        return start[0]['st_value']
+
+    @staticmethod
+    def stopped(reply):
+        if reply is None or reply[0] not in 'ST':
+            raise RuntimeError("qemu-arm stopped unexpectedly : %s" % reply)
+
+    def children(self):
+        pids = []
+        for path in glob.glob('/proc/%d/task/*/children' % self.process.pid):
+            with open(path) as f:
+                pids.extend(int(pid) for pid in f.read().split())
+        return pids
+
+    def run(self, patches, timeout=3):
+        """Run a fork of the emulated binary with the patches applied to its memory.
+
+        :param patches: list of (file offset, bytes) pairs as returned by FaultModel.patches
+        :param timeout: time in seconds after which the child is killed
+        :return: a dict with the stdout, stderr, exitcode, timedout and truncated fields of the run
+        """
+        for fd in (self.stdout, self.stderr):
+            os.ftruncate(fd, 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+        saved = []
+        for offset, value in patches:
+            addr = runtime_address(self.segments, self.base, offset)
+            # bytes that are not loaded cannot change the run, _start does not run again
+            if addr is not None and not self.cave <= addr < self.cave + len(TRAMPOLINE):
+                saved.append((addr, self.gdb.read(addr, len(value))))
+                self.gdb.write(addr, value)
+        self.gdb.set_reg(15, self.cave)
+        self.gdb.send('c')
+        timedout = False
+        reply = self.gdb.receive(timeout)
+        if reply is None:
+            timedout = True
+            for pid in self.children():
+                os.kill(pid, signal.SIGKILL)
+            reply = self.gdb.receive()
+        self.stopped(reply)
+        for addr, value in saved:
+            self.gdb.write(addr, value)
+        status = struct.unpack('<i', self.gdb.read(self.sp - STATUS_OFFSET, 4))[0]
+        exitcode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        outs, errs, truncated = read_outputs(self.stdout, self.stderr, self.limits.get('output'))
+        return {'stdout': outs, 'stderr': errs, 'exitcode': exitcode, 'timedout': timedout, 'truncated': truncated}
+
+    def close(self):
+        """Kill the emulator and its running child, if any."""
+        for pid in self.children():
+            os.kill(pid, signal.SIGKILL)
+        self.process.kill()
+        self.process.wait()
+        os.close(self.stdout)
+        os.close(self.stderr)
+
+
+def trace_executed(infile, args, sysroot='/usr/arm-linux-gnueabi/', timeout=60):
+    """Run an ARM binary under qemu-arm and return the instructions of the binary it executes.
+
+    qemu logs every block of guest code it translates (-d in_asm), which it does right before the
+    block first runs, and the gdb stub gives the load address of the binary. The instructions of
+    the loader and of the shared libraries are not recorded. It relies on the same gdb stub as
+    QemuServer and is refused with the same qemu versions.
+
+    :param infile: path of the binary
+    :param args: command line arguments of the binary
+    :param sysroot: ELF interpreter prefix passed to qemu-arm -L
+    :param timeout: time in seconds after which the run is killed
+    :return: the set of the (link-time) virtual addresses of the executed instructions of the binary
+    """
+    check_qemu()
+    infile = os.path.realpath(infile)
+    with open(infile, 'rb') as f:
+        elffile = ELFFile(f)
+        pie = elffile['e_type'] == 'ET_DYN'
+        segments = [(s['p_vaddr'], s['p_memsz']) for s in elffile.iter_segments() if s['p_type'] == 'PT_LOAD']
+    log = os.memfd_create('in_asm', 0)
+    with socket.socket() as s:  # pick a free port for the gdb stub
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    process = Popen(['qemu-arm', '-L', sysroot, '-g', str(port), '-d', 'in_asm', '-D', '/proc/self/fd/%d' % log,
+                     infile] + list(args), stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, pass_fds=(log,))
+    try:
+        gdb = GdbRemote(port)
+        offsets = dict(field.split('=') for field in gdb.command('qOffsets').split(';'))
+        base = int(offsets['Text'], 16) if pie else 0
+        gdb.send('c')
+        reply = gdb.receive(timeout)
+        if reply is None:
+            raise RuntimeError("Tracing %s timed out" % infile)
+        if reply[0] not in 'WX':
+            raise RuntimeError("qemu-arm stopped unexpectedly : %s" % reply)
+        process.wait()
+        start = base + min(vaddr for vaddr, _ in segments)
+        end = base + max(vaddr + size for vaddr, size in segments)
+        executed = set()
+        with open(log, 'r', closefd=False) as f:
+            f.seek(0)
+            for line in f:
+                # 0x00010434:  e92d4800  push     {fp, lr}
+                if line.startswith('0x'):
+                    addr = int(line.split(':', 1)[0], 16)
+                    if start <= addr < end:
+                        executed.add(addr - base)
+        return executed
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        os.close(log)
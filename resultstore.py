@@ -0,0 +1,346 @@
+import os, io, sys, csv, sqlite3, hashlib, argparse
+from elfinfo import binary_arch, function_range
+
+BATCH = 1000    # runs stored (and journaled) at a time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    infile TEXT,
+    fault TEXT,             -- name of the faulty binary
+    model TEXT,             -- fault model: JMP, JBE, Z1B, Z1W, NOP or FLP, joined by + for several faults
+    type TEXT,              -- mnemonic of the faulted instruction (jumps and zeroed values)
+    address INTEGER,        -- first faulted byte
+    size INTEGER,           -- number of faulted bytes
+    target INTEGER,         -- new target of a faulted jump
+    significance INTEGER,   -- flipped bit of a FLP fault
+    prediction TEXT,        -- outcome predicted from the disassembly, the run has no exit code if it was not run
+    key TEXT,
+    plaintext TEXT,
+    outcome TEXT,
+    exitcode INTEGER,
+    timedout INTEGER,
+    truncated INTEGER,      -- the output was longer than the limit of the campaign and is cut
+    output_hash TEXT        -- hash of the stdout and stderr of the run
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    hash TEXT PRIMARY KEY,
+    stdout BLOB,
+    stderr BLOB
+);
+CREATE INDEX IF NOT EXISTS runs_fault ON runs (fault);
+CREATE INDEX IF NOT EXISTS runs_model ON runs (model);
+CREATE INDEX IF NOT EXISTS runs_type ON runs (type);
+CREATE INDEX IF NOT EXISTS runs_address ON runs (address);
+CREATE INDEX IF NOT EXISTS runs_target ON runs (target);
+CREATE INDEX IF NOT EXISTS runs_significance ON runs (significance);
+CREATE INDEX IF NOT EXISTS runs_vector ON runs (key, plaintext);
+CREATE INDEX IF NOT EXISTS runs_outcome ON runs (outcome);
+CREATE INDEX IF NOT EXISTS runs_prediction ON runs (prediction);
+CREATE INDEX IF NOT EXISTS runs_output_hash ON runs (output_hash);
+'''
+
+COLUMNS = ('infile', 'fault', 'model', 'type', 'address', 'size', 'target', 'significance', 'prediction', 'key',
+           'plaintext', 'outcome', 'exitcode', 'timedout', 'truncated', 'output_hash')
+FAULT_COLUMNS = COLUMNS[:9]     # the columns that describe the fault, the others describe the run
+
+
+def fault_fields(fault):
+    """Returns the structured description of a fault generated by chaosduck."""
+    model = fault['fault']
+    target = fault.get('to')
+    return {'fault': fault['name'], 'model': model.name, 'type': fault.get('type'), 'address': model.addr[0],
+            'size': len(model.addr), 'target': int(target, 0) if target is not None else None,
+            'significance': fault.get('sgnf'), 'prediction': fault.get('predicted')}
+
+
+def output_hash(stdout, stderr):
+    return hashlib.sha256(len(stdout).to_bytes(8, 'little') + stdout + stderr).hexdigest()[:16]
+
+
+def csv_row(run, stdout, stderr):
+    """Row of a run in the results.csv format."""
+    return [run['infile'], run['fault'], run['key'], run['plaintext'], stdout, stderr,
+            run['exitcode'], run['timedout'], run['outcome'], run.get('prediction'), bool(run.get('truncated'))]
+
+
+class CsvStore:
+    """Writes the runs to a CSV file, the historical results.csv format.
+
+    Only the position of the rows of every fault in the file is kept in memory, the rows are read
+    back from the file when they are copied to the faults with the same image.
+    """
+
+    def __init__(self, path, append=False):
+        self.rows = {}      # fault -> (offset, length) of its rows in the file
+        self.file = open(path, 'ab+' if append else 'wb+')
+        self.size = self.file.seek(0, os.SEEK_END)
+        if append:
+            self.index()
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, delimiter=',')
+
+    def index(self):
+        # the rows of a campaign resumed from an existing file, a row ends at
+        # a line end outside of a quoted field (with an even number of quotes)
+        self.file.seek(0)
+        offset = 0
+        record = b''
+        for line in self.file:
+            record += line
+            if record.count(b'"') % 2 == 0:
+                row = next(csv.reader(io.StringIO(record.decode(), newline='')))
+                self.rows.setdefault(row[1], []).append((offset, len(record)))
+                offset += len(record)
+                record = b''
+
+    def write(self, row):
+        self.writer.writerow(row)
+        data = self.buffer.getvalue().encode()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.file.write(data)
+        self.rows.setdefault(row[1], []).append((self.size, len(data)))
+        self.size += len(data)
+
+    def add(self, run, stdout, stderr, keep):
+        self.write(csv_row(run, stdout if keep else b'', stderr if keep else b''))
+
+    def stored(self, fault):
+        """Returns the runs stored for a fault as (key, plaintext, outcome, row) tuples, to be copied."""
+        self.file.flush()
+        stored = []
+        for offset, length in self.rows.get(fault, []):
+            record = os.pread(self.file.fileno(), length, offset).decode()
+            row = next(csv.reader(io.StringIO(record, newline='')))
+            stored.append((row[2], row[3], row[8], row))
+        return stored
+
+    def copy(self, run, runs):
+        """Add the runs returned by stored again for the fault of run."""
+        for key, plaintext, outcome, row in runs:
+            self.write([run['infile'], run['fault']] + row[2:9] + [run.get('prediction')] + row[10:])
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ResultStore:
+    """Stores the runs of a campaign in an indexed SQLite database.
+
+    The runs added are inserted by flush, in a single transaction. Every run keeps the hash of its
+    output and the outputs that are stored are kept once per distinct hash in the outputs table.
+    """
+
+    def __init__(self, path, append=False):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        if self.db.execute("SELECT name FROM sqlite_master WHERE name = 'runs'").fetchone():
+            existing = [row[1] for row in self.db.execute('PRAGMA table_info(runs)')]
+            for column, kind in (('prediction', 'TEXT'), ('truncated', 'INTEGER')):
+                if column not in existing:
+                    self.db.execute('ALTER TABLE runs ADD COLUMN %s %s' %(column, kind))  # results of an older version
+        self.db.executescript(SCHEMA)
+        if not append:
+            with self.db:
+                self.db.execute('DELETE FROM runs')
+                self.db.execute('DELETE FROM outputs')
+        self.runs = []
+        self.outputs = {}
+
+    def add(self, run, stdout, stderr, keep):
+        """Add a run (a dict with the COLUMNS except output_hash), its outputs are stored if keep is true."""
+        run = dict(run)
+        run['output_hash'] = output_hash(stdout, stderr)
+        if keep:
+            self.outputs[run['output_hash']] = (stdout, stderr)
+        self.runs.append(tuple(run.get(column) for column in COLUMNS))
+
+    def stored(self, fault):
+        """Returns the runs of a fault as (key, plaintext, outcome, row) tuples, to be copied.
+
+        The runs are read from the database and from the runs not flushed yet.
+        """
+        others = COLUMNS[len(FAULT_COLUMNS):]
+        column = COLUMNS.index('fault')
+        rows = self.db.execute('SELECT %s FROM runs WHERE fault = ? ORDER BY id' %','.join(others),
+                               (fault,)).fetchall()
+        rows += [row[len(FAULT_COLUMNS):] for row in self.runs if row[column] == fault]
+        return [tuple(row[:3]) + (tuple(row),) for row in rows]
+
+    def copy(self, run, runs):
+        """Add the runs returned by stored again for the fault of run, they are inserted by the next flush."""
+        fields = tuple(run.get(column) for column in FAULT_COLUMNS)
+        self.runs.extend(fields + row for key, plaintext, outcome, row in runs)
+
+    def flush(self):
+        with self.db:
+            self.db.executemany('INSERT INTO runs (%s) VALUES (%s)' %(','.join(COLUMNS), ','.join('?' * len(COLUMNS))),
+                                self.runs)
+            self.db.executemany('INSERT OR IGNORE INTO outputs VALUES (?,?,?)',
+                                ((h, out, err) for h, (out, err) in self.outputs.items()))
+        self.runs = []
+        self.outputs = {}
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def open_store(path, append=False):
+    """Returns the store for a path: CSV for a .csv file, SQLite otherwise."""
+    return CsvStore(path, append) if path.endswith('.csv') else ResultStore(path, append)
+
+
+class Journal:
+    """Append-only list of the (fault, test vector) runs of a campaign that are stored.
+
+    The first line identifies the campaign and every other line is a stored run with its outcome.
+    The lines are written in batches, right after the runs themselves are stored, so a campaign
+    that is interrupted and launched again runs at most the last batch twice.
+    """
+
+    def __init__(self, path, campaign, restart=False):
+        """Open the journal of a campaign.
+
+        :param path: path of the journal
+        :param campaign: identifier of the campaign
+        :param restart: start over even if the journal of the same campaign exists
+        """
+        self.done = {}      # outcome of the runs of the previous launches, by (fault, key, plaintext)
+        self.pending = []
+        self.resumed = not restart and os.path.exists(path)
+        if self.resumed:
+            with open(path) as f:
+                if f.readline().rstrip('\n') != '# ' + campaign:
+                    raise ValueError("%s is the journal of another campaign (another binary or selection of "
+                                     "faults), use --restart to start over" %path)
+                line = ''
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) == 4:
+                        self.done[tuple(fields[:3])] = fields[3]
+            self.file = open(path, 'a')
+            if line and not line.endswith('\n'):
+                self.file.write('\n')  # the last line was cut by an interruption
+        else:
+            self.file = open(path, 'w')
+            self.file.write('# %s\n' %campaign)
+            self.file.flush()
+
+    def add(self, fault, key, plaintext, outcome):
+        self.pending.append('%s\t%s\t%s\t%s\n' %(fault, key, plaintext, outcome))
+
+    def flush(self):
+        self.file.write(''.join(self.pending))
+        self.file.flush()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def select(db, args):
+    """Builds the query of the runs matching the filters of the command line."""
+    where = []
+    params = []
+    for column in ('model', 'type', 'key', 'plaintext', 'outcome', 'significance', 'prediction'):
+        value = getattr(args, column)
+        if value is not None:
+            where.append('%s = ?' %column)
+            params.append(value)
+    if args.function is not None:
+        infiles = [row[0] for row in db.execute('SELECT DISTINCT infile FROM runs')]
+        if len(infiles) != 1:
+            raise ValueError("--function needs the results of a single binary")
+        # the faulted addresses are the ones of the disassembly of chaosduck (file offsets on ARM)
+        binary = args.binary or infiles[0]
+        start, end = function_range(binary, args.function, binary_arch(binary))
+        where.append('address >= ? AND address < ?')
+        params += [start, end]
+    if args.address is not None:
+        start, _, end = args.address.partition('-')
+        where.append('address >= ? AND address <= ?')
+        params += [int(start, 0), int(end or start, 0)]
+    query = ('SELECT runs.*, outputs.stdout, outputs.stderr FROM runs '
+             'LEFT JOIN outputs ON outputs.hash = runs.output_hash')
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    return db.execute(query + ' ORDER BY runs.id', params)
+
+
+def printable(row):
+    """The values of a row, with the outputs (stored as bytes) decoded as text."""
+    return [value.decode(errors='backslashreplace') if isinstance(value, bytes) else value for value in row]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Query the results of a Chaos Duck campaign')
+    parser.add_argument('database', type=str, help='SQLite results of a campaign (results.db)')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('summary', help='number of runs of each fault model for each outcome')
+    for name, text in (('query', 'print the matching runs'), ('export', 'write the matching runs as results.csv')):
+        cmd = sub.add_parser(name, help=text)
+        if name == 'export':
+            cmd.add_argument('csvfile', type=str, help='CSV file to write')
+        cmd.add_argument('--model', type=str.upper, help='fault model (JMP, JBE, Z1B, Z1W, NOP, FLP)')
+        cmd.add_argument('--type', type=str, help='mnemonic of the faulted instruction')
+        cmd.add_argument('--key', type=str, help='key of the test vector')
+        cmd.add_argument('--plaintext', type=str, help='plaintext of the test vector')
+        cmd.add_argument('--outcome', type=str, help='outcome (identical, crash:SIGSEGV, timeout, different, leak)')
+        cmd.add_argument('--significance', type=int, help='flipped bit of FLP faults')
+        cmd.add_argument('--prediction', type=str, help='outcome predicted from the disassembly')
+        cmd.add_argument('--address', type=str, help='faulted address or range START-END')
+        cmd.add_argument('--function', type=str, help='faults in this function (from the symbol table or DWARF)')
+        cmd.add_argument('--binary', type=str, help='binary to read the symbols from (default: the faulted one)')
+    sql = sub.add_parser('sql', help='run an SQL query')
+    sql.add_argument('query', type=str)
+    args = parser.parse_args(argv[1:])
+    db = sqlite3.connect(args.database)
+    try:
+        if args.command == 'summary':
+            for row in db.execute('SELECT model, outcome, COUNT(*) FROM runs GROUP BY model, outcome ORDER BY model, outcome'):
+                print('%-4s %-16s %d' %row)
+            predicted, checked, correct = db.execute(
+                'SELECT COUNT(*), COUNT(exitcode), COALESCE(SUM(exitcode IS NOT NULL AND outcome = prediction), 0) '
+                'FROM runs WHERE prediction IS NOT NULL').fetchone()
+            if predicted:
+                print('%d runs predicted, %d of them run to check the prediction, %d correct'
+                      %(predicted, checked, correct))
+        elif args.command == 'sql':
+            writer = csv.writer(sys.stdout)
+            for row in db.execute(args.query):
+                writer.writerow(printable(row))
+        else:
+            cursor = select(db, args)
+            names = [d[0] for d in cursor.description]
+            if args.command == 'query':
+                writer = csv.writer(sys.stdout)
+                writer.writerow(names)
+                for row in cursor:
+                    writer.writerow(printable(row))
+            else:
+                with open(args.csvfile, 'w', newline='') as f:
+                    writer = csv.writer(f, delimiter=',')
+                    for row in cursor:
+                        run = dict(zip(names, row))
+                        run['timedout'] = bool(run['timedout'])
+                        writer.writerow(csv_row(run, run['stdout'] or b'', run['stderr'] or b''))
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader of the output is gone (head, less), nothing more is printed
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    except (ValueError, OSError, sqlite3.Error) as e:
+        parser.error(str(e))
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
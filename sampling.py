@@ -0,0 +1,165 @@
+import math, random
+from collections import Counter
+
+FINDINGS = ('different', 'leak')    # outcomes of a successful fault
+Z = 1.96    # 95% confidence
+
+
+def wilson(successes, n):
+    """Returns the 95% Wilson score interval of a success rate."""
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    center = (p + Z * Z / (2 * n)) / (1 + Z * Z / n)
+    half = Z * math.sqrt(p * (1 - p) / n + Z * Z / (4 * n * n)) / (1 + Z * Z / n)
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+class Stratum:
+    """The faults of a stratum in a random order and the outcomes of the ones sampled."""
+
+    def __init__(self, key):
+        self.key = key
+        self.faults = []
+        self.next = 0       # faults before this index are sampled or were run by a previous launch
+        self.sampled = 0
+        self.done = 0       # sampled faults whose runs are all recorded
+        self.successes = 0
+
+    def remaining(self):
+        return len(self.faults) - self.next
+
+    def interval(self):
+        return wilson(self.successes, self.done)
+
+
+class StratifiedSampler:
+    """Samples the faults of a campaign stratified by a key, until a budget or a precision is reached.
+
+    The faults are enumerated once and shuffled in each stratum. Sampling goes in rounds of a
+    window of faults, the size of a round is split among the strata whose success rate is not
+    yet known with the target precision, in proportion to their size and to the standard deviation
+    of their success rate (Neyman allocation). A fault is a success if one of its runs is a finding
+    (different or leak). The sampler is iterated lazily by the campaign, which reports every
+    recorded run to observe, so that every round is allocated with the outcomes of the previous ones.
+    """
+
+    def __init__(self, faults, stratum, budget, precision=None, window=1000, runs=9, seed=0):
+        """Enumerate and shuffle the faults.
+
+        :param faults: iterable of the faults (dicts with a 'name')
+        :param stratum: function returning the stratum of a fault
+        :param budget: maximum number of faults sampled
+        :param precision: target half-width of the confidence interval of every stratum, None to use the budget
+        :param window: number of faults sampled per round
+        :param runs: number of runs (test vectors) of a fault
+        :param seed: seed of the random order of the faults
+        """
+        self.budget = budget
+        self.precision = precision
+        self.window = window
+        self.runs = runs
+        self.strata = {}
+        self.where = {}     # name of a fault -> its stratum and index
+        rng = random.Random(seed)
+        for f in faults:
+            key = stratum(f)
+            if key not in self.strata:
+                self.strata[key] = Stratum(key)
+            self.strata[key].faults.append(f)
+        for s in self.strata.values():
+            rng.shuffle(s.faults)
+            for i, f in enumerate(s.faults):
+                self.where[f['name']] = (s, i)
+        self.sampled = 0
+        self.recorded = Counter()   # runs recorded for a sampled fault
+        self.success = set()        # sampled faults with a finding
+
+    def observe(self, name, outcome):
+        """Record the outcome of a run of a fault, sampled now or by a previous launch."""
+        if name not in self.where:
+            return
+        s, i = self.where[name]
+        if i >= s.next:
+            # run by a previous launch of the campaign, it is moved to the sampled faults
+            s.faults[s.next], s.faults[i] = s.faults[i], s.faults[s.next]
+            self.where[s.faults[i]['name']] = (s, i)
+            self.where[name] = (s, s.next)
+            s.next += 1
+            s.sampled += 1
+            self.sampled += 1
+        self.recorded[name] += 1
+        if outcome in FINDINGS and name not in self.success:
+            self.success.add(name)
+            s.successes += 1
+        if self.recorded[name] == self.runs:
+            s.done += 1
+
+    def precise(self, s):
+        if self.precision is None or s.done < s.sampled:
+            return False
+        low, high = s.interval()
+        return s.done > 0 and (high - low) / 2 <= self.precision
+
+    def allocate(self, size):
+        """Returns the number of faults to sample from each stratum in the next round."""
+        strata = [s for s in self.strata.values() if s.remaining() > 0 and not self.precise(s)]
+        weights = {}
+        for s in strata:
+            p = (s.successes + 1) / (s.done + 2)    # rate smoothed for the strata without a run yet
+            weights[s.key] = len(s.faults) * math.sqrt(p * (1 - p))
+        total = sum(weights.values())
+        if total == 0:
+            return {}
+        share = {s.key: min(s.remaining(), size * weights[s.key] / total) for s in strata}
+        counts = {key: max(1, int(value)) for key, value in share.items()}
+        # the rest of the round goes to the largest remainders
+        for key in sorted(share, key=lambda key: share[key] - int(share[key]), reverse=True):
+            if sum(counts.values()) >= size:
+                break
+            if counts[key] < self.strata[key].remaining():
+                counts[key] += 1
+        return counts
+
+    def __iter__(self):
+        while self.sampled < self.budget:
+            counts = self.allocate(min(self.window, self.budget - self.sampled))
+            if not counts:
+                break
+            for key, count in counts.items():
+                s = self.strata[key]
+                for f in s.faults[s.next:s.next + count]:
+                    if self.sampled >= self.budget:
+                        break
+                    s.next += 1
+                    s.sampled += 1
+                    self.sampled += 1
+                    yield f
+
+    def report(self):
+        """Print the success rate of every stratum with its confidence interval and the estimate of the binary."""
+        print("\nSuccess rate of the faults (different or leak) with 95% confidence intervals:")
+        print("%-44s %8s %8s %8s %8s %17s" % ('stratum', 'faults', 'sampled', 'run', 'success', 'rate'))
+        estimate = variance = 0
+        estimated = True
+        population = sum(len(s.faults) for s in self.strata.values())
+        for key in sorted(self.strata, key=str):
+            s = self.strata[key]
+            low, high = s.interval()
+            rate = s.successes / s.done if s.done else 0
+            print("%-44s %8d %8d %8d %8d %5.1f%% [%4.1f-%5.1f%%]" % ('/'.join(str(k) for k in key), len(s.faults),
+                  s.sampled, s.done, s.successes, 100 * rate, 100 * low, 100 * high))
+            if s.done:
+                weight = len(s.faults) / population
+                estimate += weight * rate
+                # finite population correction, a stratum run entirely is exact
+                variance += weight * weight * rate * (1 - rate) / s.done * (1 - s.done / len(s.faults))
+            else:
+                estimated = False
+        if not estimated:
+            print("Some strata have no run yet, the success rate of the binary is not estimated")
+        else:
+            half = Z * math.sqrt(variance)
+            print("Estimated success rate of the binary: %.2f%% [%.2f-%.2f%%] (%d faults out of %d run)"
+                  % (100 * estimate, 100 * max(0, estimate - half), 100 * min(1, estimate + half),
+                     sum(s.done for s in self.strata.values()), population))
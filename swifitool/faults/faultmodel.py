@@ -9,8 +9,23 @@ class FaultModel:
         self.config = config
         self.args = args
 
+    def edited_ranges(self):
+        """Returns the bits edited by the fault model as a list of [start, end) bit offset intervals."""
+
     def edited_memory_locations(self):
         """Returns the locations of the bits edited by the fault model."""
+        return [m for start, end in self.edited_ranges() for m in range(start, end)]
+
+    def patches(self, data):
+        """Returns the bytes written by the fault model as a list of (offset, bytes) pairs.
+
+        :param data: the content of the file the fault model is applied to
+        """
 
     def apply(self, opened_file):
         """Apply the fault model to the given file."""
+        opened_file.seek(0)
+        data = opened_file.read()
+        for offset, value in self.patches(data):
+            opened_file.seek(offset)
+            opened_file.write(value)
@@ -1,5 +1,3 @@
-import os
-
 from faults.faultmodel import FaultModel
 from utils import *
 
@@ -19,22 +17,18 @@ class JMP(FaultModel):
             absolute_target = int(args[1], 0)
         except ValueError:
             check_or_fail(False, "Invalid target for JMP : " + args[1])
-        check_or_fail(0 <= absolute_target < os.stat(config.infile).st_size, "Target outside the file")
-        f = open(self.config.infile, 'rb')
-        f.seek(self.addr[0])
+        check_or_fail(0 <= absolute_target < config.size, "Target outside the file")
+        check_or_fail(0 <= self.addr[0] < config.size - 3, "Address outside the file : " + args[0])
+        data = config.data
         if self.config.arch == 'x86':
-            b0 = ord(f.read(1))
-            b1 = ord(f.read(1))
+            b0 = data[self.addr[0]]
+            b1 = data[self.addr[0] + 1]
             if b0 == 0xEB:
                 self.target = absolute_target - (self.addr[0] + 1 + 1)
                 check_or_fail(-2 ** 7 <= self.target < 2 ** 7, "Target value out of range : " + str(self.target))
                 self.type = 0  # opcode EB
             elif b0 == 0xE9:
-                try:
-                    f.seek(self.addr[0] - 1)
-                    b_prev = ord(f.read(1))
-                except ValueError:
-                    b_prev = 0
+                b_prev = data[self.addr[0] - 1] if self.addr[0] > 0 else 0
                 if b_prev == 0x66:
                     self.addr = [self.addr[0] - 1]
                     self.target = absolute_target - (self.addr[0] + 2 + 2)
@@ -51,42 +45,32 @@ class JMP(FaultModel):
             else:
                 check_or_fail(False, "Unknown opcode at JMP address : " + hex(b0))
         elif self.config.arch == 'arm':
-            f.seek(self.addr[0] + 3)
-            b3 = ord(f.read(1))
+            b3 = data[self.addr[0] + 3]
             if b3 == 0xEA:
                 self.target = absolute_target - (self.addr[0] + 8)
                 check_or_fail(-2 ** 25 <= self.target < 2 ** 25, "Target value out of range : " + str(self.target))
                 self.type = 3  # unconditional B
             else:
                 check_or_fail(False, "Unknown opcode at JMP address : " + hex(b3))
-        f.close()
 
-    def edited_memory_locations(self):
+    def edited_ranges(self):
         if self.type == 0:
-            return bits_list(range(self.addr[0] + 1, self.addr[0] + 2))
+            return bits_range(self.addr[0] + 1, self.addr[0] + 2)
         elif self.type == 1:
-            return bits_list(range(self.addr[0] + 1, self.addr[0] + 5))
+            return bits_range(self.addr[0] + 1, self.addr[0] + 5)
         elif self.type == 2:
-            return bits_list(range(self.addr[0] + 2, self.addr[0] + 4))
+            return bits_range(self.addr[0] + 2, self.addr[0] + 4)
         elif self.type == 3:
-            return bits_list(range(self.addr[0], self.addr[0] + 3))
+            return bits_range(self.addr[0], self.addr[0] + 3)
 
-    def apply(self, opened_file):
+    def patches(self, data):
         if self.type == 0:
-            opened_file.seek(self.addr[0] + 1)
-            opened_file.write(bytes([self.target & 0xFF]))
+            return [(self.addr[0] + 1, bytes([self.target & 0xFF]))]
         elif self.type == 1:
-            opened_file.seek(self.addr[0] + 1)
-            opened_file.write(bytes([self.target & 0xFF]))
-            opened_file.write(bytes([self.target >> 8 & 0xFF]))
-            opened_file.write(bytes([self.target >> 16 & 0xFF]))
-            opened_file.write(bytes([self.target >> 24 & 0xFF]))
+            return [(self.addr[0] + 1, bytes([self.target & 0xFF, self.target >> 8 & 0xFF,
+                                              self.target >> 16 & 0xFF, self.target >> 24 & 0xFF]))]
         elif self.type == 2:
-            opened_file.seek(self.addr[0] + 2)
-            opened_file.write(bytes([self.target & 0xFF]))
-            opened_file.write(bytes([self.target >> 8 & 0xFF]))
+            return [(self.addr[0] + 2, bytes([self.target & 0xFF, self.target >> 8 & 0xFF]))]
         elif self.type == 3:
-            opened_file.seek(self.addr[0])
-            opened_file.write(bytes([self.target >> 2 & 0xFF]))
-            opened_file.write(bytes([self.target >> 10 & 0xFF]))
-            opened_file.write(bytes([self.target >> 18 & 0xFF]))
+            return [(self.addr[0], bytes([self.target >> 2 & 0xFF, self.target >> 10 & 0xFF,
+                                          self.target >> 18 & 0xFF]))]
@@ -0,0 +1,31 @@
+from faults.faultmodel import FaultModel
+
+
+class MULTI(FaultModel):
+    """Several fault models editing disjoint bits, applied together as one fault."""
+    nb_args = 0
+
+    def __init__(self, config, fault_models):
+        super().__init__(config, fault_models)
+        self.fault_models = fault_models
+        self.name = '+'.join(f.name for f in fault_models)
+        self.addr = sorted(set(a for f in fault_models for a in f.addr))
+
+    def edited_ranges(self):
+        return sorted(r for f in self.fault_models for r in f.edited_ranges())
+
+    def patches(self, data):
+        # each model is patched against the original data, the bits they change
+        # are disjoint so that their differences are combined by a xor
+        changed = {}
+        for f in self.fault_models:
+            for offset, value in f.patches(data):
+                for i, b in enumerate(value, offset):
+                    changed[i] = changed.get(i, data[i]) ^ data[i] ^ b
+        patches = []
+        for i in sorted(changed):
+            if patches and patches[-1][0] + len(patches[-1][1]) == i:
+                patches[-1][1].append(changed[i])
+            else:
+                patches.append((i, bytearray([changed[i]])))
+        return [(offset, bytes(value)) for offset, value in patches]
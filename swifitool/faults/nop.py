@@ -14,23 +14,20 @@ class NOP(FaultModel):
         if self.config.arch == 'arm' and len(self.addr) != 1:
             check_or_fail(len(self.addr) % 2 == 0, "Range of addresses for NOP must be multiple of two on ARM")
 
-    def edited_memory_locations(self):
+    def edited_ranges(self):
         if len(self.addr) == 1:
             if self.config.arch == 'x86':
-                return bits_list(self.addr)
+                return bits_range(self.addr[0], self.addr[0] + 1)
             else:
-                return bits_list(range(self.addr[0], self.addr[0] + 2))
+                return bits_range(self.addr[0], self.addr[0] + 2)
         else:
-            return bits_list(self.addr)
+            return bits_range(self.addr[0], self.addr[-1] + 1)
 
-    def apply(self, opened_file):
+    def patches(self, data):
         if self.config.arch == 'x86':
-            set_bytes(opened_file, self.addr[0], 0x90, nb_repeat=len(self.addr))
+            return [(self.addr[0], bytes([0x90] * len(self.addr)))]
         else:
             if len(self.addr) == 1:
-                set_bytes(opened_file, self.addr[0], 0b00000000)
-                set_bytes(opened_file, self.addr[0] + 1, 0b10111111)
+                return [(self.addr[0], bytes([0b00000000, 0b10111111]))]
             else:
-                for i in range(len(self.addr) // 2):
-                    set_bytes(opened_file, self.addr[0] + 2 * i, 0b00000000)
-                    set_bytes(opened_file, self.addr[0] + 2 * i + 1, 0b10111111)
+                return [(self.addr[0], bytes([0b00000000, 0b10111111] * (len(self.addr) // 2)))]
@@ -11,8 +11,8 @@ class Z1B(FaultModel):
         super().__init__(config, args)
         self.addr = parse_addr(args[0])
 
-    def edited_memory_locations(self):
-        return bits_list(self.addr)
+    def edited_ranges(self):
+        return bits_range(self.addr[0], self.addr[-1] + 1)
 
-    def apply(self, opened_file):
-        set_bytes(opened_file, self.addr[0], nb_repeat=len(self.addr))
+    def patches(self, data):
+        return [(self.addr[0], bytes(len(self.addr)))]
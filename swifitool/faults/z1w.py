@@ -14,14 +14,14 @@ class Z1W(FaultModel):
         check_or_fail(len(self.addr) == 1 or len(self.addr) % config.word_length == 0,
                       "Range of addresses for Z1W must be multiple of the word length")
 
-    def edited_memory_locations(self):
+    def edited_ranges(self):
         if len(self.addr) == 1:
-            return bits_list(range(self.addr[0], self.addr[0] + self.config.word_length))
+            return bits_range(self.addr[0], self.addr[0] + self.config.word_length)
         else:
-            return bits_list(self.addr)
+            return bits_range(self.addr[0], self.addr[-1] + 1)
 
-    def apply(self, opened_file):
+    def patches(self, data):
         if len(self.addr) == 1:
-            set_bytes(opened_file, self.addr[0], nb_repeat=self.config.word_length)
+            return [(self.addr[0], bytes(self.config.word_length))]
         else:
-            set_bytes(opened_file, self.addr[0], nb_repeat=len(self.addr))
+            return [(self.addr[0], bytes(len(self.addr)))]
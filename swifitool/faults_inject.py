@@ -1,7 +1,11 @@
 import argparse
+import io
+import json
 import shutil
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import redirect_stderr
 
 from faults.flp import FLP
 from faults.jbe import JBE
@@ -9,11 +13,11 @@ from faults.jmp import JMP
 from faults.nop import NOP
 from faults.z1b import Z1B
 from faults.z1w import Z1W
-from utils import check_or_fail
+from utils import check_or_fail, FaultError, IntervalIndex
 
 
 class ExecConfig:
-    """Keeps the configuration variables."""
+    """Keeps the configuration variables and a read-only copy of the input file."""
 
     def __init__(self, infile, outfile, arch, word_length):
         super().__init__()
@@ -21,17 +25,142 @@ class ExecConfig:
         self.outfile = outfile
         self.arch = arch
         self.word_length = word_length
+        # read the input once so that the fault models decode it without any file I/O
+        with open(infile, 'rb') as f:
+            self.data = f.read()
+        self.size = len(self.data)
 
 
-def main(argv):
-    fault_models = {'FLP': FLP, 'Z1B': Z1B, 'Z1W': Z1W, 'NOP': NOP, 'JMP': JMP, 'JBE': JBE}
+FAULT_MODELS = {'FLP': FLP, 'Z1B': Z1B, 'Z1W': Z1W, 'NOP': NOP, 'JMP': JMP, 'JBE': JBE}
+
+
+def parse_fault_models(config, tokens):
+    """Build the fault models of a list of tokens, each model name followed by its parameters.
+
+    :param config: the configuration of the input
+    :param tokens: the fault models and their parameters as strings
+    :return: a list of fault models
+    """
+    check_or_fail(len(tokens) >= 1, "No fault models provided")
+    fm_list = []
+    indices = [i for i, x in enumerate(tokens) if FAULT_MODELS.get(x) is not None]
+    indices.append(len(tokens))
+
+    for i in range(len(indices) - 1):
+        n = indices[i]
+        fm_name = tokens[n]
+        fm_type = FAULT_MODELS.get(fm_name)
+        if fm_type is not None:
+            check_or_fail(indices[i + 1] - n - 1 == fm_type.nb_args, "Wrong number of parameters for " + fm_name)
+            ar = []
+            for j in range(fm_type.nb_args):
+                ar.append(tokens[n + 1 + j])
+            fm_list.append(fm_type(config, ar))
+    return fm_list
+
+
+def check_fault_models(config, fm_list):
+    """Check that the faults do not overlap and do not write outside the end of the file.
+
+    :param config: the configuration of the input
+    :param fm_list: the fault models
+    """
+    index = IntervalIndex()
+    max_bits = config.size * 8
+    for f in fm_list:
+        for start, end in f.edited_ranges():
+            check_or_fail(0 <= start, "Address outside file content : byte " + hex(start // 8))
+            check_or_fail(end <= max_bits, "Address outside file content : byte " + hex(max(start, max_bits) // 8))
+            other = index.overlap(start, end)
+            if other is not None:
+                check_or_fail(False, "Applying two fault models at the same place : byte "
+                              + hex(max(start, other[0]) // 8))
+            index.add(start, end, f.name)
+
+
+def write_faulty(config, outfile, fm_list):
+    """Write a copy of the input with the faults applied, from the input read once.
+
+    :param config: the configuration of the input
+    :param outfile: path to the destination file
+    :param fm_list: the fault models
+    """
+    data = bytearray(config.data)
+    for f in fm_list:
+        for offset, value in f.patches(data):
+            data[offset:offset + len(value)] = value
+    with open(outfile, 'wb') as file:
+        file.write(data)
+    shutil.copymode(config.infile, outfile)
+
+
+def run_batch(config, manifest, jobs):
+    """Write every output of a manifest, one JSON object per line with an outfile and its faults.
+
+    The faults of a line are a list of tokens or a string, as on the command line. A line with an
+    error is reported with its number and skipped, the other lines are written in parallel.
+
+    :param config: the configuration of the input
+    :param manifest: path to the JSONL manifest
+    :param jobs: number of outputs written at a time
+    :return: the number of lines with an error
+    """
+    errors = []
+    outputs = {}
+    with open(manifest, 'r') as mf:
+        for number, line in enumerate(mf, 1):
+            if not line.strip():
+                continue
+            try:
+                # the messages are reported with the number of the line
+                with redirect_stderr(io.StringIO()):
+                    entry = json.loads(line)
+                    check_or_fail(isinstance(entry, dict) and isinstance(entry.get('outfile'), str),
+                                  "No outfile given")
+                    outfile = os.path.expanduser(entry['outfile'])
+                    if outfile in outputs:
+                        check_or_fail(False, "Output already written by line %d" % outputs[outfile][0])
+                    tokens = entry.get('faults', [])
+                    check_or_fail(isinstance(tokens, (str, list)), "The faults must be a list or a string")
+                    tokens = tokens.split() if isinstance(tokens, str) else [str(t) for t in tokens]
+                    fm_list = parse_fault_models(config, tokens)
+                    check_fault_models(config, fm_list)
+                outputs[outfile] = (number, fm_list)
+            except json.JSONDecodeError as e:
+                errors.append((number, "Invalid JSON : " + str(e)))
+            except FaultError as e:
+                errors.append((number, e.msg))
 
+    written = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(write_faulty, config, outfile, fm_list): number
+                   for outfile, (number, fm_list) in outputs.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                written += 1
+            except OSError as e:
+                errors.append((futures[future], str(e)))
+
+    for number, msg in sorted(errors):
+        sys.stderr.write("Line %d : %s\n" % (number, msg))
+    print("%d outputs written, %d lines with an error" % (written, len(errors)))
+    return len(errors)
+
+
+def main(argv):
     # Collect parameters
     parser = argparse.ArgumentParser(description='Software implemented fault injection tool',
                                      formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('-i', '--infile', type=str, metavar='INFILE', required=True, help='path to the source file')
-    parser.add_argument('-o', '--outfile', type=str, metavar='OUTFILE', required=True,
+    parser.add_argument('-o', '--outfile', type=str, metavar='OUTFILE', required=False,
                         help='path to the destination file')
+    parser.add_argument('-b', '--batch', type=str, metavar='MANIFEST', required=False,
+                        help='write many outputs instead of one, from a JSONL file with one output per line:\n' +
+                             '{"outfile": "out.bin", "faults": ["NOP", "0x5a0", "FLP", "0x5b2", "3"]}\n' +
+                             'the lines with an error are reported and skipped')
+    parser.add_argument('-j', '--jobs', type=int, metavar='JOBS', required=False, default=os.cpu_count() or 1,
+                        help='number of outputs written at a time in batch mode (default: number of CPUs)')
     parser.add_argument('-w', '--wordsize', type=int, metavar='WORDSIZE', required=False,
                         help='number of bytes in a word')
     parser.add_argument('-a', '--arch', type=str, metavar='ARCHITECTURE', required=False, choices=['x86', 'arm'],
@@ -42,10 +171,21 @@ def main(argv):
                         help='read the faults models from a file instead of command line')
     parser.add_argument('fault_models', nargs='*', metavar='FAULT_MODEL',
                         help='one fault model followed by its parameters\n' +
-                             'The possible models are :\n' + "\n".join([s.docs for s in fault_models.values()]) +
+                             'The possible models are :\n' + "\n".join([s.docs for s in FAULT_MODELS.values()]) +
                              '\naddr can be a number or a range (number-number)')
     args = parser.parse_args(argv[1:])
     check_or_fail(args.wordsize is None or args.wordsize > 0, "Word size must be positive")
+    check_or_fail((args.outfile is None) != (args.batch is None), "Either an output file or a batch manifest required")
+
+    if args.batch is not None:
+        check_or_fail(not args.fault_models and args.fromfile is None and not args.graphical,
+                      "The fault models of a batch are read from its manifest")
+        check_or_fail(args.jobs > 0, "Number of jobs must be positive")
+        # the input is read once for all the outputs
+        config = ExecConfig(os.path.expanduser(args.infile), None, args.arch, args.wordsize)
+        if run_batch(config, os.path.expanduser(args.batch), args.jobs):
+            exit(-1)
+        return
 
     # General configuration
     config = ExecConfig(os.path.expanduser(args.infile), os.path.expanduser(args.outfile), args.arch, args.wordsize)
@@ -54,30 +194,10 @@ def main(argv):
     if args.fromfile is not None:
         with open(args.fromfile, 'r') as ff:
             args.fault_models.extend(ff.read().split())
-    check_or_fail(len(args.fault_models) >= 1, "No fault models provided")
-    fm_list = []
-    indices = [i for i, x in enumerate(args.fault_models) if fault_models.get(x) is not None]
-    indices.append(len(args.fault_models))
-
-    for i in range(len(indices) - 1):
-        n = indices[i]
-        fm_name = args.fault_models[n]
-        fm_type = fault_models.get(fm_name)
-        if fm_type is not None:
-            check_or_fail(indices[i + 1] - n - 1 == fm_type.nb_args, "Wrong number of parameters for " + fm_name)
-            ar = []
-            for j in range(fm_type.nb_args):
-                ar.append(args.fault_models[n + 1 + j])
-            fm_list.append(fm_type(config, ar))
+    fm_list = parse_fault_models(config, args.fault_models)
 
     # Check that the faults do not overlap and do not write outside the end of the file
-    mem = {}
-    max_bits = os.stat(config.infile).st_size * 8
-    for f in fm_list:
-        for m in f.edited_memory_locations():
-            check_or_fail(0 <= m < max_bits, "Address outside file content : byte " + hex(m // 8))
-            check_or_fail(mem.get(m) is None, "Applying two fault models at the same place : byte " + hex(m // 8))
-            mem[m] = f.name
+    check_fault_models(config, fm_list)
 
     # Duplicate the input and then apply the faults
     shutil.copy(config.infile, config.outfile)
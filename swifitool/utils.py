@@ -1,4 +1,13 @@
 import sys
+from bisect import bisect_right, insort
+
+
+class FaultError(SystemExit):
+    """Raised by check_or_fail: exits with the code -1 unless caught, and keeps the error message."""
+
+    def __init__(self, msg):
+        super().__init__(-1)
+        self.msg = msg
 
 
 def check_or_fail(condition, msg):
@@ -10,7 +19,7 @@ def check_or_fail(condition, msg):
     if not condition:
         if 'Target value out of range : ' not in msg:
             sys.stderr.write(msg + "\n")
-        exit(-1)
+        raise FaultError(msg)
 
 
 def set_bytes(outfile, start_addr, value=0, nb_repeat=1):
@@ -49,6 +58,46 @@ def bits_list(bytes_l):
     return bits_l
 
 
+def bits_range(start, end):
+    """Transform a range of byte offsets to an interval of bit offsets.
+
+    :param start: first offset of the range
+    :param end: offset after the range
+    :return: a list with one [start, end) interval of bit offsets
+    """
+    return [(start * 8, end * 8)]
+
+
+class IntervalIndex:
+    """Disjoint [start, end) intervals sorted by start, each with the name of its owner."""
+
+    def __init__(self):
+        self.intervals = []
+
+    def overlap(self, start, end):
+        """Returns an interval of the index that overlaps [start, end), or None.
+
+        :param start: first offset of the interval
+        :param end: offset after the interval
+        :return: a (start, end, owner) tuple
+        """
+        i = bisect_right(self.intervals, (start, float('inf')))
+        if i > 0 and self.intervals[i - 1][1] > start:
+            return self.intervals[i - 1]
+        if i < len(self.intervals) and self.intervals[i][0] < end:
+            return self.intervals[i]
+        return None
+
+    def add(self, start, end, owner):
+        """Add an interval that does not overlap the ones of the index.
+
+        :param start: first offset of the interval
+        :param end: offset after the interval
+        :param owner: name of the owner of the interval
+        """
+        insort(self.intervals, (start, end, owner))
+
+
 def parse_addr(addr):
     """Parse a string representing an address or a range of addresses to an list of integer address(es).
     Exit with error if format is wrong.